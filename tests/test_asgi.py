@@ -0,0 +1,199 @@
+import asyncio
+import threading
+import unittest
+
+import xhttp
+
+def run(app, method, path, headers=(), body=b"", query_string=b""):
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": query_string,
+        "http_version": "1.1",
+        "headers": [ (name.encode("latin-1"), value.encode("latin-1")) for (name, value) in headers ],
+        "server": ("localhost", 8000),
+        "client": ("127.0.0.1", 12345)
+    }
+    messages = [ { "type": "http.request", "body": body[:5], "more_body": True },
+                 { "type": "http.request", "body": body[5:], "more_body": False } ]
+    sent = []
+    async def receive():
+        return messages.pop(0)
+    async def send(message):
+        sent.append(message)
+    asyncio.run(app(scope, receive, send))
+    start = sent[0]
+    body = b"".join(message["body"] for message in sent[1:])
+    return (start["status"], dict(start["headers"]), body)
+
+#
+# TestAsgiApp
+#
+
+class TestAsgiApp(unittest.TestCase):
+    def test_sync_handler(self):
+        @xhttp.xhttp_asgi_app
+        def app(req):
+            return {
+                "x-status": xhttp.status.OK,
+                "x-content": "{0} {1} {2}".format(req["x-request-method"], req["x-path-info"], req["x-query-string"]).encode("ascii"),
+                "content-type": "text/plain"
+            }
+        status, headers, body = run(app, "GET", "/hello", query_string=b"a=b")
+        self.assertEqual(status, 200)
+        self.assertEqual(headers, { b"content-type": b"text/plain", b"content-length": b"14" })
+        self.assertEqual(body, b"GET /hello a=b")
+
+    def test_sync_handler_in_thread(self):
+        threads = []
+        @xhttp.xhttp_asgi_app
+        def app(req):
+            threads.append(threading.current_thread())
+            return { "x-status": xhttp.status.OK, "x-content": b"Hello, world!\n" }
+        self.assertEqual(run(app, "GET", "/")[2], b"Hello, world!\n")
+        # called off the event loop's thread
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_async_handler(self):
+        @xhttp.xhttp_asgi_app
+        async def app(req):
+            await asyncio.sleep(0)
+            return {
+                "x-status": xhttp.status.OK,
+                "x-content": req["x-wsgi-input"].read(),
+                "content-type": req["content-type"]
+            }
+        status, headers, body = run(app, "POST", "/", [("Content-Type", "text/plain")], b"Hello, world!\n")
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b"content-type"], b"text/plain")
+        self.assertEqual(body, b"Hello, world!\n")
+
+    def test_async_content(self):
+        async def chunks():
+            for chunk in [b"Hello,", b" ", b"world!", b"\n"]:
+                await asyncio.sleep(0)
+                yield chunk
+        @xhttp.xhttp_asgi_app
+        async def app(req):
+            return { "x-status": xhttp.status.OK, "x-content": chunks() }
+        self.assertEqual(run(app, "GET", "/"), (200, {}, b"Hello, world!\n"))
+
+    def test_decorators(self):
+        class Hello(xhttp.Resource):
+            @xhttp.accept_encoding
+            @xhttp.cache_control("max-age=60")
+            @xhttp.if_none_match
+            @xhttp.accept
+            async def GET(self, req):
+                await asyncio.sleep(0)
+                return {
+                    "x-status": xhttp.status.OK,
+                    "x-content": { "message": "Hello, world!" },
+                    "x-content-view": { "application/json": lambda content: content },
+                    "etag": '"hello"'
+                }
+
+        @xhttp.xhttp_asgi_app
+        @xhttp.accept_charset
+        @xhttp.catcher
+        @xhttp.get({ "name?": r"^\w+$" })
+        async def app(req):
+            return await xhttp.Router((r"^/hello$", Hello()))(req)
+
+        status, headers, body = run(app, "GET", "/hello", [("Accept", "application/json")])
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b"cache-control"], b"max-age=60")
+        self.assertEqual(headers[b"content-type"], b"application/json; charset=UTF-8")
+        self.assertEqual(body, b'{\n    "message": "Hello, world!"\n}')
+
+        status, headers, body = run(app, "HEAD", "/hello", [("Accept", "application/json")])
+        self.assertEqual((status, body), (200, b""))
+
+        status, headers, body = run(app, "GET", "/hello", [("If-None-Match", '"hello"')])
+        self.assertEqual(status, 304)
+        self.assertEqual(headers[b"cache-control"], b"max-age=60")
+
+        status, headers, body = run(app, "GET", "/hello", [("Accept", "image/png")])
+        self.assertEqual(status, 406)
+
+        status, headers, body = run(app, "GET", "/hello", query_string=b"name=%20")
+        self.assertEqual(status, 400)
+
+    def test_errors_caught(self):
+        @xhttp.xhttp_asgi_app
+        @xhttp.accept_charset
+        @xhttp.catcher
+        async def app(req):
+            raise xhttp.exc.HTTPNotFound(detail="nope")
+        self.assertEqual(run(app, "GET", "/")[0], 404)
+
+    def test_app_cached(self):
+        calls = []
+        @xhttp.xhttp_asgi_app
+        @xhttp.app_cached(size=10)
+        async def app(req):
+            calls.append(req["x-path-info"])
+            return { "x-status": xhttp.status.OK, "x-content": b"Hello, world!\n" }
+        self.assertEqual(run(app, "GET", "/")[1][b"x-cache"], b"MISS")
+        self.assertEqual(run(app, "GET", "/")[1][b"x-cache"], b"HIT")
+        self.assertEqual(calls, ["/"])
+
+    def test_lifespan(self):
+        @xhttp.xhttp_asgi_app
+        def app(req):
+            pass
+        messages = [{ "type": "lifespan.startup" }, { "type": "lifespan.shutdown" }]
+        sent = []
+        async def receive():
+            return messages.pop(0)
+        async def send(message):
+            sent.append(message["type"])
+        asyncio.run(app({ "type": "lifespan" }, receive, send))
+        self.assertEqual(sent, ["lifespan.startup.complete", "lifespan.shutdown.complete"])
+
+    def test_body_too_large(self):
+        class app(xhttp.xhttp_asgi_app):
+            MAX_BODY_SIZE = 8
+        calls = []
+        @app
+        def handler(req):
+            calls.append(req)
+            return { "x-status": xhttp.status.OK }
+        status, headers, body = run(handler, "POST", "/", body=b"x" * 9)
+        self.assertEqual((status, body), (413, b"Request Entity Too Large: Body is larger than 8 bytes\n"))
+        status, headers, body = run(handler, "POST", "/", [("Content-Length", "100")], body=b"x" * 4)
+        self.assertEqual(status, 413)
+        self.assertEqual(run(handler, "POST", "/", body=b"x" * 8)[0], 200)
+        self.assertEqual(len(calls), 1)
+
+    def test_disconnect(self):
+        calls = []
+        @xhttp.xhttp_asgi_app
+        def app(req):
+            calls.append(req)
+            return { "x-status": xhttp.status.OK }
+        scope = { "type": "http", "method": "POST", "path": "/", "headers": [] }
+        messages = [ { "type": "http.request", "body": b"spam=", "more_body": True },
+                     { "type": "http.disconnect" } ]
+        sent = []
+        async def receive():
+            return messages.pop(0)
+        async def send(message):
+            sent.append(message)
+        asyncio.run(app(scope, receive, send))
+        # the handler isn't called with half a body
+        self.assertEqual((calls, sent), ([], []))
+
+    def test_sync_content_in_thread(self):
+        threads = []
+        def chunks():
+            for chunk in [b"Hello,", b" world!\n"]:
+                threads.append(threading.current_thread())
+                yield chunk
+        @xhttp.xhttp_asgi_app
+        def app(req):
+            return { "x-status": xhttp.status.OK, "x-content": chunks() }
+        self.assertEqual(run(app, "GET", "/"), (200, {}, b"Hello, world!\n"))
+        # iterated off the event loop's thread
+        self.assertNotIn(threading.current_thread(), threads)
@@ -3,7 +3,16 @@ from __future__ import division, absolute_import, print_function#, unicode_liter
 import unittest
 import os
 import os.path
+import mmap
+import pickle
+import shutil
+import signal
+import socket
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 
 if sys.version_info[0] == 3:
     import io
@@ -12,6 +21,11 @@ if sys.version_info[0] == 2:
     import StringIO as io
     assert io
 
+if sys.version_info[0] == 3:
+    import http.client as httplib
+elif sys.version_info[0] == 2:
+    import httplib
+
 import xhttp
 
 #
@@ -55,9 +69,38 @@ class TestQlist(unittest.TestCase):
     def test_negotiate_bad_header(self):
         qlist = xhttp.headers.QListHeader("text/plain;q=albatross")
         result = qlist.negotiate_mime(["image/png", "audio/mpeg"])
-        self.assertEqual(qlist.items, [])
+        self.assertEqual(qlist.items, ())
         self.assertEqual(result, None)
 
+    def test_interned(self):
+        s = "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8"
+        qlist = xhttp.headers.QListHeader(s)
+        self.assertIs(xhttp.headers.QListHeader(s), qlist)
+        self.assertIsNot(xhttp.headers.QListHeader(s + ",image/png"), qlist)
+        self.assertIsInstance(qlist.items, tuple)
+
+    def test_negotiate_memoized(self):
+        qlist = xhttp.headers.QListHeader("text/*;q=0.5,application/json")
+        keys = { "text/html": 1, "application/json": 2 }
+        self.assertEqual(qlist.negotiate_mime(keys.keys()), "application/json")
+        self.assertEqual(qlist.memo.get(("negotiate_mime", ("text/html", "application/json"))), "application/json")
+        self.assertEqual(qlist.negotiate_mime(["image/png", "text/plain"]), "text/plain")
+        self.assertEqual(len(qlist.memo), 2)
+
+    def test_negotiate_memo_lru(self):
+        class QListHeader(xhttp.headers.QListHeader):
+            MEMO_SIZE = 2
+        qlist = QListHeader("text/html")
+        qlist.negotiate(["text/html"])
+        qlist.negotiate(["text/plain"])
+        qlist.negotiate(["text/html"])
+        # later keys are still remembered, evicting the least recently used
+        qlist.negotiate(["application/json"])
+        self.assertEqual(len(qlist.memo), 2)
+        self.assertTrue(("negotiate", ("application/json",)) in qlist.memo)
+        self.assertTrue(("negotiate", ("text/html",)) in qlist.memo)
+        self.assertFalse(("negotiate", ("text/plain",)) in qlist.memo)
+
     def test_repr(self):
         qlist = xhttp.headers.QListHeader("text/plain;q=0.9, application/xhtml+xml")
         result = repr(qlist)
@@ -76,6 +119,31 @@ class TestQlist(unittest.TestCase):
         result = qlist.negotiate(["gzip"])
         self.assertEqual(result, None)
 
+#
+# TestHeaderValue
+#
+
+class TestHeaderValue(unittest.TestCase):
+    def test_immutable(self):
+        for value in [xhttp.headers.QListHeader("gzip"), xhttp.headers.DateHeader(0), xhttp.headers.RangeHeader("bytes=0-1")]:
+            self.assertFalse(hasattr(value, "__dict__"))
+            with self.assertRaises(AttributeError):
+                value.foo = 1
+            with self.assertRaises(AttributeError):
+                del value.text
+
+    def test_pickle(self):
+        for value in [xhttp.headers.QListHeader("text/html,*/*;q=0.8"), xhttp.headers.DateHeader(392425860), xhttp.headers.RangeHeader("bytes=0-13,-5")]:
+            copy = pickle.loads(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+            self.assertEqual(type(copy), type(value))
+            self.assertEqual(str(copy), str(value))
+
+    def test_lowered(self):
+        qlist = xhttp.headers.QListHeader("Text/HTML,GZip;q=0.5")
+        self.assertEqual(qlist.lowered, ("text/html", "gzip"))
+        self.assertEqual(qlist.negotiate(["gzip"]), "GZip")
+        self.assertEqual(str(xhttp.headers.RangeHeader("bytes=0-13, 17-19,-5")), "bytes=0-13,17-19,-5")
+
 #
 # TestDateHeader
 #
@@ -104,6 +172,20 @@ class TestDateHeader(unittest.TestCase):
         date = xhttp.headers.DateHeader(392425860)
         self.assertEqual(str(date), "Tue, 08 Jun 1982 23:11:00 GMT")
 
+    def test_obsolete_formats(self):
+        self.assertEqual(xhttp.headers.DateHeader("Tuesday, 08-Jun-82 23:11:00 GMT").timestamp, 392425860)
+        self.assertEqual(xhttp.headers.DateHeader("Tue Jun  8 23:11:00 1982").timestamp, 392425860)
+
+    def test_fallback(self):
+        self.assertEqual(xhttp.headers.DateHeader("1982-06-08T23:11:00Z").timestamp, 392425860)
+        with self.assertRaises(ValueError):
+            xhttp.headers.DateHeader("Tue, 32 Jun 1982 23:11:00 GMT")
+        with self.assertRaises(ValueError):
+            xhttp.headers.DateHeader("Sat, 31 Feb 2024 00:00:00 GMT")
+        with self.assertRaises(ValueError):
+            xhttp.headers.DateHeader("Sun Feb 29 00:00:00 2023")
+        self.assertEqual(xhttp.headers.DateHeader("Thu, 29 Feb 2024 00:00:00 GMT").timestamp, 1709164800)
+
     def test_wrong_input(self):
         with self.assertRaises(ValueError) as ex:
             xhttp.headers.DateHeader(None)
@@ -142,10 +224,11 @@ class TestRangeHeader(unittest.TestCase):
         self.assertEqual(r.start, 0)
         self.assertEqual(r.stop, 13)
 
-    def test_annoying_range(self):
-        with self.assertRaises(xhttp.exc.HTTPException) as ex:
-            xhttp.headers.RangeHeader("bytes=0-13,17-19")
-        self.assertEqual(ex.exception.status, 501)
+    def test_multiple_ranges(self):
+        r = xhttp.headers.RangeHeader("bytes=0-13, 17-19,-5")
+        self.assertEqual(r.ranges, ((0, 13), (17, 19), (None, 5)))
+        self.assertEqual((r.start, r.stop), (0, 13))
+        self.assertEqual(repr(r), "RangeHeader('bytes', ((0, 13), (17, 19), (None, 5)))")
 
     def test_no_start(self):
         r = xhttp.headers.RangeHeader("bytes=-13")
@@ -273,6 +356,105 @@ class TestXhttpAppDecorator(unittest.TestCase):
         result = app(environ, start_response)
         self.assertEqual(result, [b"Hello, world!\n"])
 
+    def test_preserialized_headers(self):
+        static = xhttp.xhttp_app.serialize_headers({ "content-type": "text/plain", "cache-control": "max-age=60" })
+        self.assertEqual(static, [("Cache-Control", "max-age=60"), ("Content-Type", "text/plain")])
+        @xhttp.xhttp_app
+        def app(request):
+            return {
+                "x-status": xhttp.status.OK,
+                "x-content": b"Hello, world!\n",
+                "x-headers": static }
+        def start_response(status, headers):
+            self.assertEqual(status, "200 OK")
+            self.assertEqual(headers, static + [("Content-Length", "14")])
+            headers.append(("Date", "today"))
+        app(gen_environ("GET", "/", {}), start_response)
+        app(gen_environ("GET", "/", {}), start_response)
+        self.assertEqual(len(static), 2)
+
+    def test_preserialized_headers_replaced(self):
+        static = xhttp.xhttp_app.serialize_headers({ "content-type": "text/plain", "cache-control": "max-age=60" })
+        @xhttp.xhttp_app
+        def app(request):
+            return {
+                "x-status": xhttp.status.OK,
+                "x-content": b"{}",
+                "content-type": "application/json",
+                "x-headers": static }
+        def start_response(status, headers):
+            self.assertEqual(headers, [("Cache-Control", "max-age=60"), ("Content-Length", "2"), ("Content-Type", "application/json")])
+        app(gen_environ("GET", "/", {}), start_response)
+
+    def test_status_line(self):
+        self.assertEqual(xhttp.xhttp_app.status_line(404), "404 Not Found")
+        self.assertIs(xhttp.xhttp_app.status_line(404), xhttp.xhttp_app.status_line(404))
+        with self.assertRaises(KeyError):
+            xhttp.xhttp_app.status_line(599)
+
+    def test_unsorted_headers(self):
+        class unsorted_app(xhttp.xhttp_app):
+            SORT_HEADERS = False
+        @unsorted_app
+        def app(request):
+            return {
+                "x-status": xhttp.status.NOT_FOUND,
+                "x-content": [b"Not found\n"],
+                "content-type": "text/plain",
+                "content-length": 10 }
+        def start_response(status, headers):
+            self.assertEqual(status, "404 Not Found")
+            self.assertEqual(headers, [
+                ("Content-Type", "text/plain"),
+                ("Content-Length", "10") ])
+        app(gen_environ("GET", "/", {}), start_response)
+
+#
+# TestLazyRequest
+#
+
+class TestLazyRequest(unittest.TestCase):
+    def parse(self, headers):
+        return xhttp.xhttp_app(None).parse_request(gen_environ("GET", "/hello?a=b", headers))
+
+    def test_lookup(self):
+        req = self.parse({ "Accept": "text/html", "X-Spam": "albatross" })
+        self.assertEqual(req["x-path-info"], "/hello")
+        self.assertEqual(req["x-spam"], "albatross")
+        self.assertEqual(req.get("x-eggs", "none"), "none")
+        self.assertIsNone(req["content-type"])
+        self.assertTrue("accept" in req)
+        self.assertFalse("accept-charset" in req)
+        with self.assertRaises(KeyError):
+            req["accept-charset"]
+
+    def test_parses_once(self):
+        req = self.parse({ "Accept": "text/html" })
+        self.assertEqual(dict.__len__(req), 0)
+        accept = req["accept"]
+        self.assertIsInstance(accept, xhttp.headers.QListHeader)
+        self.assertIs(req["accept"], accept)
+        self.assertEqual(dict.__len__(req), 1)
+
+    def test_materialize(self):
+        req = self.parse({ "Accept": "text/html" })
+        req["x-get"] = {}
+        plain = dict(req)
+        self.assertEqual(len(plain), 16)
+        self.assertEqual(plain["x-query-string"], "a=b")
+        self.assertEqual(plain["x-get"], {})
+        self.assertEqual(req, plain)
+
+    def test_pop(self):
+        req = self.parse({ "Accept": "text/html" })
+        self.assertEqual(req.pop("x-request-method"), "GET")
+        self.assertFalse("x-request-method" in req)
+
+    def test_bad_header_is_lazy(self):
+        req = self.parse({ "If-Modified-Since": "albatross" })
+        self.assertEqual(req["x-request-method"], "GET")
+        with self.assertRaises(ValueError):
+            req["if-modified-since"]
 
 #
 # TestResource
@@ -451,6 +633,60 @@ class TestRouter(unittest.TestCase):
             "x-status": 204
         })
 
+    def test_first_match_wins(self):
+        app = xhttp.Router(
+            (r'^/users/(\d+)/$', 'user'),
+            (r'^/users/([^/]+)/$', 'named-user'),
+            (r'(?i)^/USERS/$', 'users'),
+            (r'^/(\w+)/(\w+)/$', 'anything'),
+            (r'^/(a)\1/$', 'backref'))
+        self.assertEqual(app.find('/users/23/'), ('user', ('23',)))
+        self.assertEqual(app.find('/users/spam/'), ('named-user', ('spam',)))
+        self.assertEqual(app.find('/users/'), ('users', ()))
+        self.assertEqual(app.find('/spam/eggs/'), ('anything', ('spam', 'eggs')))
+        self.assertEqual(app.find('/aa/'), ('backref', ('a',)))
+        self.assertEqual(app.find('/spam/'), (None, None))
+
+    def test_resolve(self):
+        app = xhttp.Router(
+            (r'^/static/(.+)$', 'static'),
+            (r'^/hello/$', 'hello'),
+            (r'^/hello/(w%C3%B6rld)/$', 'world'))
+        self.assertEqual(app.resolve('/hello/'), ('hello', (), False))
+        self.assertEqual(app.resolve('/hello'), ('hello', (), True))
+        self.assertEqual(app.resolve('/hello/w%C3%B6rld'), ('world', (u'w\u00f6rld',), True))
+        self.assertEqual(app.resolve('/static/foo.js'), ('static', ('foo.js',), False))
+        self.assertEqual(app.resolve('/goodbye'), (None, None, False))
+
+    def test_cache(self):
+        cache = xhttp.cache.LRUCache(2)
+        inner = xhttp.Router((r'^/hello/$', HelloWorld()), prefix='/inner', cache=cache)
+        app = xhttp.Router((r'^/inner/', inner), (r'^/hello/$', HelloWorld()), cache=cache)
+        def request(path):
+            return {
+                "x-request-method": "GET",
+                "x-request-uri": path,
+                "x-path-info": path,
+                "x-query-string": "",
+            }
+        self.assertEqual(app(request("/hello/"))["x-status"], 200)
+        self.assertEqual(app(request("/hello/"))["x-status"], 200)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(app(request("/inner/hello/"))["x-status"], 200)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+        self.assertEqual(len(cache), 2)
+        for _ in range(2):
+            with self.assertRaises(xhttp.exc.HTTPException) as ex:
+                app(request("/hello"))
+            self.assertEqual(ex.exception.status, 303)
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+        self.assertFalse((app, "/hello/") in cache)
+
+    def test_no_cache(self):
+        app = HelloWorldRouter()
+        self.assertIsNone(app.cache)
+        self.assertIsInstance(xhttp.Router(cache=10).cache, xhttp.cache.LockedLRUCache)
+
 #
 # TestAccept
 #
@@ -570,6 +806,39 @@ class TestAccept(unittest.TestCase):
             "content-type": "application/json; charset=UTF-8",
         })
 
+    def test_json_modes(self):
+        content = { "b": [1, 2.5, None], "a": u"Hell\u00f8" }
+        pretty = xhttp.negotiation.json_serializer("pretty")(content)
+        self.assertEqual(pretty, u'{\n    "a": "Hell\u00f8",\n    "b": [\n        1,\n        2.5,\n        null\n    ]\n}')
+        expected = u'{"b":[1,2.5,null],"a":"Hell\u00f8"}'.encode("utf8")
+        self.assertEqual(xhttp.negotiation.json_serializer("compact")(content), expected)
+        orjson, xhttp.negotiation.orjson = xhttp.negotiation.orjson, None
+        try:
+            self.assertEqual(xhttp.negotiation.json_serializer("compact")(content), expected)
+        finally:
+            xhttp.negotiation.orjson = orjson
+        chunks = list(xhttp.negotiation.json_serializer("stream", chunk_size=4)(content))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(b"".join(chunks), expected)
+        self.assertEqual(xhttp.negotiation.json_serializer("compact", dumps=lambda content: u"custom")(content), b"custom")
+        with self.assertRaises(ValueError):
+            xhttp.negotiation.json_serializer("ugly")
+
+    def test_compact_accept(self):
+        serializers = dict(xhttp.negotiation.SERIALIZERS, **{
+            "application/json": xhttp.negotiation.json_serializer("compact")
+        })
+        accept = xhttp.custom_accept(serializers)
+        serializers.clear()
+        # bytes either way, so @accept_charset isn't needed
+        @accept
+        def app(req):
+            return { "x-status": 200, "x-content": { "n": 2 ** 70 }, "x-content-view": { "application/json": lambda m: m } }
+        response = app({ "accept": xhttp.headers.QListHeader("application/json") })
+        # too big for orjson, so json does it
+        self.assertEqual(response["x-content"], b'{"n":1180591620717411303424}')
+        self.assertEqual(response["content-type"], "application/json; charset=UTF-8")
+
     def test_application_xhtml_xml(self):
         app = HelloContentNegotiatingWorld()
         response = app({
@@ -669,7 +938,7 @@ class TestGet(unittest.TestCase):
             "list1+": "^\d+$",
             "list2*": "^[a-z]+$" })(None)
         with self.assertRaises(xhttp.exc.HTTPException) as ex:
-            app({ "x-query-string": "required=required&optional=albatross&optional=albatross&list1=23&list1=46&list2=aa" })
+            app({ "x-query-string": "required=spam&optional=albatross&optional=albatross&list1=23&list1=46&list2=aa" })
         self.assertEqual(ex.exception.status, 400)
         self.assertEqual(ex.exception.args[0], "Bad Request")
         self.assertEqual(ex.exception.headers, { "x-detail": "GET parameter 'optional' should occur at most once" })
@@ -722,6 +991,12 @@ class TestGet(unittest.TestCase):
             self.assertEqual(req["x-get"]["message"], u"hej, v\ufffdrld")
         app({ "x-query-string": "message=hej%2C%20v%E4rld" })
 
+    def test_no_query_string(self):
+        @xhttp.get({ "small?": "^(true|false)$", "list*": "^[a-z]+$" })
+        def app(req):
+            return req["x-get"]
+        self.assertEqual(app({ "x-query-string": None }), { "small": None, "list": [] })
+
     def test_single_1(self):
         @xhttp.get({ "small?": "^(true|false)$" })
         def app(req):
@@ -738,6 +1013,29 @@ class TestGet(unittest.TestCase):
                         if sys.version_info[0] == 2 else
                         "GET parameter 'small' has bad value 'foo'"
         })
+
+    def test_repeated_keys(self):
+        @xhttp.get({ "a*": "^\\d+$", "b?": "^.*$" })
+        def app(req):
+            return req["x-get"]
+        self.assertEqual(app({ "x-query-string": "a=1&b=x%3Dy&a=2&&a=3" }), { "a": ["1", "2", "3"], "b": "x=y" })
+        self.assertEqual(app({ "x-query-string": "b" }), { "a": [], "b": "" })
+
+    def test_fail_fast(self):
+        app = xhttp.get({ "a": "^\\d+$" })(None)
+        with self.assertRaises(xhttp.exc.HTTPException) as ex:
+            app({ "x-query-string": "b=1&a=x" })
+        self.assertEqual(ex.exception.headers, { "x-detail": "Unknown GET parameter 'b'" })
+
+    def test_stats(self):
+        app = xhttp.get({ "a": "^\\d+$" })(lambda req: req["x-get"])
+        app({ "x-query-string": "a=1" })
+        with self.assertRaises(xhttp.exc.HTTPException):
+            app({ "x-query-string": "a=1&a=2" })
+        stats = app.parser.stats()
+        self.assertEqual((stats["parses"], stats["failures"]), (2, 1))
+        self.assertTrue(stats["seconds"] > 0)
+
 #
 # TestPost
 #
@@ -753,6 +1051,14 @@ class TestPost(unittest.TestCase):
             "x-wsgi-input": io.StringIO(content)
         })
 
+    @unittest.skipUnless(sys.version_info[0] == 3, "bytes are str in Python 2")
+    def test_post_bytes(self):
+        @xhttp.post({ "spam": "^albatross$" })
+        def app(req):
+            return req["x-post"]["spam"]
+        content = b"spam=albatross"
+        self.assertEqual(app({ "content-length": len(content), "x-wsgi-input": io.BytesIO(content) }), "albatross")
+
     def test_post_with_bad_content_length(self):
         app = xhttp.post({ "spam": "^albatross$" })(None)
         content = "spam=albatross"
@@ -765,6 +1071,203 @@ class TestPost(unittest.TestCase):
         self.assertEqual(ex.exception.args[0], "Bad Request")
         self.assertEqual(ex.exception.headers, { "x-detail": "POST parameter 'spam' should occur exactly once" })
 
+    def test_too_large(self):
+        app = xhttp.post({ "spam": "^.*$" }, max_size=10)(lambda req: req["x-post"])
+        content = b"spam=albatross"
+        with self.assertRaises(xhttp.exc.HTTPException) as ex:
+            app({ "content-length": len(content), "x-wsgi-input": io.BytesIO(content) })
+        self.assertEqual(ex.exception.status, 413)
+        # a lying content-length doesn't get past the limit either
+        with self.assertRaises(xhttp.exc.HTTPException) as ex:
+            app({ "transfer-encoding": "chunked", "x-wsgi-input-terminated": True, "x-wsgi-input": io.BytesIO(content) })
+        self.assertEqual(ex.exception.status, 413)
+
+    def test_too_many_fields(self):
+        app = xhttp.post({ "spam*": "^.*$" }, max_fields=3)(lambda req: req["x-post"])
+        content = b"spam=1&spam=2&spam=3&spam=4"
+        with self.assertRaises(xhttp.exc.HTTPException) as ex:
+            app({ "content-length": len(content), "x-wsgi-input": io.BytesIO(content) })
+        self.assertEqual(ex.exception.status, 400)
+        self.assertEqual(ex.exception.headers, { "x-detail": "More than 3 POST parameters" })
+
+    def test_chunked(self):
+        app = xhttp.post({ "spam": "^albatross$", "eggs+": "^.*$" })(lambda req: req["x-post"])
+        content = b"7\r\nspam=al\r\nb;ext=1\r\nbatross&egg\r\n9\r\ns=1&eggs=\r\n1\r\n2\r\n0\r\nTrailer: x\r\n\r\n"
+        self.assertEqual(app({ "transfer-encoding": "chunked", "x-wsgi-input": io.BytesIO(content) }),
+                         { "spam": "albatross", "eggs": ["1", "2"] })
+        with self.assertRaises(xhttp.exc.HTTPException) as ex:
+            app({ "transfer-encoding": "chunked", "x-wsgi-input": io.BytesIO(b"zz\r\n") })
+        self.assertEqual(ex.exception.status, 400)
+
+    def test_chunked_terminated(self):
+        app = xhttp.post({ "spam": "^albatross$" })(lambda req: req["x-post"])
+        content = b"spam=albatross"
+        self.assertEqual(app({ "transfer-encoding": "chunked", "x-wsgi-input-terminated": True, "x-wsgi-input": io.BytesIO(content) }),
+                         { "spam": "albatross" })
+
+    def test_read_in_chunks(self):
+        reads = []
+        class Input(io.BytesIO):
+            def read(self, size=-1):
+                reads.append(size)
+                return io.BytesIO.read(self, size)
+        content = b"spam=" + b"a" * 100000
+        app = xhttp.post({ "spam": "^a+$" })(lambda req: len(req["x-post"]["spam"]))
+        self.assertEqual(app({ "content-length": len(content), "x-wsgi-input": Input(content) }), 100000)
+        self.assertTrue(all(0 < size <= xhttp.utils.CHUNK_SIZE for size in reads))
+
+#
+# TestMultipart
+#
+
+def multipart_body(*parts):
+    body = b""
+    for (headers, content) in parts:
+        body += b"--XyZ\r\n" + b"".join(h + b"\r\n" for h in headers) + b"\r\n" + content + b"\r\n"
+    return body + b"--XyZ--\r\n"
+
+class TestMultipart(unittest.TestCase):
+    CONTENT_TYPE = "multipart/form-data; boundary=XyZ"
+
+    def request(self, body, chunk_size=7, content_type=CONTENT_TYPE):
+        chunks = [ body[i:i+chunk_size] for i in range(0, len(body), chunk_size) ]
+        class Input(object):
+            def read(self, size=-1):
+                return chunks.pop(0) if chunks else b""
+        return { "content-type": content_type, "content-length": len(body), "x-wsgi-input": Input() }
+
+    def test_fields_and_files(self):
+        @xhttp.multipart({ "title": r"(?s)^.*$", "tags*": r"^\w+$", "upload": r"^.*\.txt$" }, spool_size=10)
+        def app(req):
+            return req["x-post"]
+        body = multipart_body(
+            ([b'Content-Disposition: form-data; name="title"'], "Caf\u00e9 \r\n--Xy-".encode("utf8")),
+            ([b'Content-Disposition: form-data; name="tags"'], b"spam"),
+            ([b'Content-Disposition: form-data; name="tags"'], b"eggs"),
+            ([b'Content-Disposition: form-data; name="upload"; filename="C:\\Temp\\notes.txt"',
+              b"Content-Type: text/plain"], b"x" * 100 + b"\r\n--Xy"))
+        post = app(self.request(body))
+        self.assertEqual(post["title"], "Caf\u00e9 \r\n--Xy-")
+        self.assertEqual(post["tags"], ["spam", "eggs"])
+        upload = post["upload"]
+        self.assertEqual((upload.filename, upload.content_type, upload.size), ("notes.txt", "text/plain", 106))
+        self.assertEqual(upload.read(), b"x" * 100 + b"\r\n--Xy")
+        # past spool_size, the content went to disk
+        self.assertTrue(upload.file._rolled)
+        upload.close()
+
+    def test_bad_values(self):
+        app = xhttp.multipart({ "upload": r"^.*\.txt$" })(lambda req: req["x-post"])
+        body = multipart_body(([b'Content-Disposition: form-data; name="upload"; filename="evil.exe"'], b"MZ"))
+        with self.assertRaises(xhttp.exc.HTTPException) as ex:
+            app(self.request(body))
+        self.assertEqual(ex.exception.headers, { "x-detail": "POST parameter 'upload' has bad value 'evil.exe'" })
+
+        body = multipart_body(([b'Content-Disposition: form-data; name="spam"'], b"eggs"))
+        with self.assertRaises(xhttp.exc.HTTPException) as ex:
+            app(self.request(body))
+        self.assertEqual(ex.exception.headers, { "x-detail": "Unknown POST parameter 'spam'" })
+
+        with self.assertRaises(xhttp.exc.HTTPException) as ex:
+            app(self.request(body[:-10]))
+        self.assertEqual(ex.exception.status, 400)
+
+        with self.assertRaises(xhttp.exc.HTTPException) as ex:
+            app(self.request(body, content_type="application/x-www-form-urlencoded"))
+        self.assertEqual(ex.exception.status, 415)
+
+    def test_empty_file_input(self):
+        app = xhttp.multipart({ "upload?": r"^.*$" })(lambda req: req["x-post"])
+        body = multipart_body(([b'Content-Disposition: form-data; name="upload"; filename=""',
+                                b"Content-Type: application/octet-stream"], b""))
+        self.assertEqual(app(self.request(body)), { "upload": None })
+
+    def test_limits(self):
+        app = xhttp.multipart({ "title": r"^.*$" }, field_size=10)(lambda req: req["x-post"])
+        body = multipart_body(([b'Content-Disposition: form-data; name="title"'], b"x" * 11))
+        with self.assertRaises(xhttp.exc.HTTPException) as ex:
+            app(self.request(body))
+        self.assertEqual(ex.exception.status, 413)
+
+        app = xhttp.multipart({ "title": r"^.*$" }, max_size=10)(lambda req: req["x-post"])
+        with self.assertRaises(xhttp.exc.HTTPException) as ex:
+            app(self.request(body))
+        self.assertEqual(ex.exception.status, 413)
+
+#
+# TestJsonBody
+#
+
+class TestJsonBody(unittest.TestCase):
+    SCHEMA = {
+        "type": "object",
+        "required": ["name"],
+        "additionalProperties": False,
+        "properties": {
+            "name": { "type": "string", "pattern": r"^\w+$", "maxLength": 10 },
+            "age": { "type": "integer", "minimum": 0 },
+            "tags": { "type": "array", "items": { "enum": ["spam", "eggs"] }, "maxItems": 2 }
+        }
+    }
+
+    def request(self, content, content_type="application/json"):
+        return { "content-type": content_type, "content-length": len(content), "x-wsgi-input": io.BytesIO(content) }
+
+    def test_json_body(self):
+        app = xhttp.json_body(self.SCHEMA)(lambda req: req["x-json"])
+        content = b'{"name": "brian", "age": 33, "tags": ["spam"]}'
+        self.assertEqual(app(self.request(content)), { "name": "brian", "age": 33, "tags": ["spam"] })
+        self.assertEqual(app(self.request(b'{"name": "brian"}', "application/vnd.api+json; charset=utf-8")), { "name": "brian" })
+
+    def test_invalid(self):
+        app = xhttp.json_body(self.SCHEMA)(lambda req: req["x-json"])
+        cases = [
+            (b'[]', "JSON body $ should be object"),
+            (b'{}', "JSON body $ should have property 'name'"),
+            (b'{"name": "brian", "x": 1}', "JSON body $ has unknown property 'x'"),
+            (b'{"name": "brian!"}', "JSON body $.name should match '^\\\\w+$'"),
+            (b'{"name": "brian", "age": true}', "JSON body $.age should be integer"),
+            (b'{"name": "brian", "age": -1}', "JSON body $.age should be at least 0"),
+            (b'{"name": "brian", "tags": ["ham"]}', 'JSON body $.tags[0] should be one of ["spam", "eggs"]'),
+            (b'{"name": "brian", "tags": ["spam", "spam", "eggs"]}', "JSON body $.tags has a bad number of items")
+        ]
+        for (content, detail) in cases:
+            with self.assertRaises(xhttp.exc.HTTPException) as ex:
+                app(self.request(content))
+            self.assertEqual(ex.exception.status, 400)
+            self.assertEqual(ex.exception.headers, { "x-detail": detail })
+
+    def test_bad_requests(self):
+        app = xhttp.json_body(max_size=16)(lambda req: req["x-json"])
+        with self.assertRaises(xhttp.exc.HTTPException) as ex:
+            app(self.request(b'{"name": '))
+        self.assertEqual(ex.exception.status, 400)
+        with self.assertRaises(xhttp.exc.HTTPException) as ex:
+            app(self.request(b'{"name": "brian"}'))
+        self.assertEqual(ex.exception.status, 413)
+        with self.assertRaises(xhttp.exc.HTTPException) as ex:
+            app(self.request(b'name=brian', "application/x-www-form-urlencoded"))
+        self.assertEqual(ex.exception.status, 415)
+
+    def test_unsupported_schema(self):
+        with self.assertRaises(ValueError):
+            xhttp.forms.compile_schema({ "oneOf": [] })
+        with self.assertRaises(ValueError):
+            xhttp.forms.compile_schema({ "type": "thing" })
+
+    def test_big_integers(self):
+        app = xhttp.json_body({ "properties": { "n": { "type": "integer" } } })(lambda req: req["x-json"])
+        for n in [2 ** 64, -2 ** 63 - 1, 10 ** 400]:
+            self.assertEqual(app(self.request('{{"n": {0}}}'.format(n).encode("ascii"))), { "n": n })
+
+    def test_without_orjson(self):
+        orjson, xhttp.forms.orjson = xhttp.forms.orjson, None
+        try:
+            app = xhttp.json_body()(lambda req: req["x-json"])
+            self.assertEqual(app(self.request('{"name": "Caf\u00e9"}'.encode("utf8"))), { "name": "Caf\u00e9" })
+        finally:
+            xhttp.forms.orjson = orjson
+
 #
 # TestIfModifiedSince
 #
@@ -968,6 +1471,94 @@ class TestIfNoneMatch(unittest.TestCase):
             app({ "if-none-match": "A" })
         self.assertEqual(ex.exception.status, 304)
 
+#
+# TestValidators
+#
+
+class ValidatedResource(xhttp.Resource):
+    def __init__(self):
+        self.calls = 0
+
+    def etag(self, req, key):
+        return "etag-" + key
+
+    def last_modified(self, req, key):
+        return xhttp.headers.DateHeader("Mon, 23 Jul 2012 20:00:00 +0200")
+
+    @xhttp.if_modified_since
+    @xhttp.if_none_match
+    @xhttp.validators(etag=etag, last_modified=last_modified)
+    def GET(self, req, key):
+        self.calls += 1
+        return {
+            "x-status": xhttp.status.OK,
+            "x-content": b"Hello, world!\n",
+            "content-type": "text/plain",
+            "etag": self.etag(req, key),
+            "last-modified": self.last_modified(req, key)
+        }
+
+class TestValidators(unittest.TestCase):
+    def test_etag_match(self):
+        app = ValidatedResource()
+        with self.assertRaises(xhttp.exc.HTTPException) as ex:
+            app({ "x-request-method": "GET", "if-none-match": "etag-a" }, "a")
+        self.assertEqual(ex.exception.status, 304)
+        self.assertEqual(app.calls, 0)
+
+    def test_etag_mismatch(self):
+        app = ValidatedResource()
+        response = app({ "x-request-method": "GET", "if-none-match": "etag-a" }, "b")
+        self.assertEqual(response["etag"], "etag-b")
+        self.assertEqual(app.calls, 1)
+
+    def test_not_modified(self):
+        app = ValidatedResource()
+        with self.assertRaises(xhttp.exc.HTTPException) as ex:
+            app({
+                "x-request-method": "GET",
+                "if-modified-since": xhttp.headers.DateHeader("Mon, 23 Jul 2012 20:00:00 +0200")
+            }, "a")
+        self.assertEqual(ex.exception.status, 304)
+        self.assertEqual(app.calls, 0)
+
+    def test_modified(self):
+        app = ValidatedResource()
+        response = app({
+            "x-request-method": "GET",
+            "if-modified-since": xhttp.headers.DateHeader("Wed, 09 Jun 1982 01:11:00 +0200")
+        }, "a")
+        self.assertEqual(response["x-status"], 200)
+        self.assertEqual(app.calls, 1)
+
+    def test_function(self):
+        calls = []
+        @xhttp.if_none_match
+        @xhttp.validators(etag=lambda req: "A")
+        def app(req):
+            calls.append(req)
+            return { "x-status": xhttp.status.OK, "etag": "A" }
+        with self.assertRaises(xhttp.exc.HTTPException) as ex:
+            app({ "if-none-match": "A" })
+        self.assertEqual(ex.exception.status, 304)
+        self.assertEqual(calls, [])
+
+    def test_over_decorator(self):
+        class Resource(xhttp.Resource):
+            calls = 0
+            def etag(self, req):
+                return '"hello"'
+            @xhttp.if_none_match
+            @xhttp.validators(etag=etag)
+            @xhttp.accept
+            def GET(self, req):
+                Resource.calls += 1
+                return { "x-status": xhttp.status.OK, "x-content": "hello", "x-content-view": { "text/plain": lambda m: m } }
+        with self.assertRaises(xhttp.exc.HTTPException) as ex:
+            Resource()({ "x-request-method": "GET", "if-none-match": '"hello"' })
+        self.assertEqual(ex.exception.status, 304)
+        self.assertEqual(Resource.calls, 0)
+
 #
 # TestServeFile
 #
@@ -977,18 +1568,18 @@ class TestIfNoneMatch(unittest.TestCase):
 class TestServeFile(unittest.TestCase):
     def test_existing_file(self):
         result = xhttp.utils.serve_file("tests/data/hello-world.txt", "text/plain", last_modified=False, etag=False)
+        self.assertEqual(b"".join(result.pop("x-content")), b"Hello, world!\n")
         self.assertEqual(result, {
             "x-status": 200,
-            "x-content": b"Hello, world!\n",
             "content-type": "text/plain",
             "content-length": 14,
         })
 
     def test_last_modified(self):
         result = xhttp.utils.serve_file("tests/data/hello-world.txt", "text/plain", last_modified=True, etag=False)
+        self.assertEqual(b"".join(result.pop("x-content")), b"Hello, world!\n")
         self.assertEqual(result, {
             "x-status": 200,
-            "x-content": b"Hello, world!\n",
             "content-type": "text/plain",
             "content-length": 14,
             "last-modified": xhttp.headers.DateHeader(os.path.getmtime("tests/data/hello-world.txt"))
@@ -996,14 +1587,26 @@ class TestServeFile(unittest.TestCase):
 
     def test_etag(self):
         result = xhttp.utils.serve_file("tests/data/hello-world.txt", "text/plain", last_modified=False, etag=True)
+        self.assertEqual(b"".join(result.pop("x-content")), b"Hello, world!\n")
         self.assertEqual(result, {
             "x-status": 200,
-            "x-content": b"Hello, world!\n",
             "content-type": "text/plain",
             "content-length": 14,
             "etag": "d9014c4624844aa5bac314773d6b689ad467fa4e1d1a50a1b8a99d5a95f72ff5"
         })
 
+    def test_etag_cached(self):
+        xhttp.utils.etag_cache.clear()
+        result_1 = xhttp.utils.serve_file("tests/data/hello-world.txt", "text/plain", last_modified=False, etag=True)
+        result_2 = xhttp.utils.serve_file("tests/data/hello-world.txt", "text/plain", last_modified=False, etag=True)
+        self.assertEqual(result_1["etag"], result_2["etag"])
+        self.assertEqual((xhttp.utils.etag_cache.hits, xhttp.utils.etag_cache.misses), (1, 1))
+
+    def test_weak_etag(self):
+        result = xhttp.utils.serve_file("tests/data/hello-world.txt", "text/plain", last_modified=False, etag="weak")
+        stat = os.stat("tests/data/hello-world.txt")
+        self.assertEqual(result["etag"], 'W/"{0:x}-e-{1:x}"'.format(stat.st_ino, stat.st_mtime_ns))
+
     def test_not_found(self):
         with self.assertRaises(xhttp.exc.HTTPException) as ex:
             xhttp.utils.serve_file("tests/data/albatross.txt", "text/plain")
@@ -1011,6 +1614,25 @@ class TestServeFile(unittest.TestCase):
         self.assertEqual(ex.exception.args[0], "Not Found")
         self.assertEqual(ex.exception.headers, { "x-detail": "No such file or directory" })
 
+    def test_directory(self):
+        with self.assertRaises(xhttp.exc.HTTPException) as ex:
+            xhttp.utils.serve_file("tests/data", "text/plain")
+        self.assertEqual(ex.exception.status, 404)
+        with self.assertRaises(xhttp.exc.HTTPException) as ex:
+            xhttp.FileServer("tests", "text/plain").GET({ "x-request-method": "GET" }, "data")
+        self.assertEqual(ex.exception.status, 404)
+
+    def test_unreadable(self):
+        # root can read anything, so access is refused by replacing os.access
+        orig_access = os.access
+        os.access = lambda path, mode: False
+        try:
+            with self.assertRaises(xhttp.exc.HTTPException) as ex:
+                xhttp.utils.serve_file("tests/data/hello-world.txt", "text/plain")
+        finally:
+            os.access = orig_access
+        self.assertEqual(ex.exception.status, 403)
+
     def test_file_read_throws_exception(self):
         class MockOpen(object):
             def __init__(self, filename, mode):
@@ -1044,20 +1666,118 @@ class TestFileServer(unittest.TestCase):
     def test_found(self):
         app = xhttp.FileServer("tests/data", "text/plain", last_modified=False, etag=False)
         response = app({ "x-request-method": "GET" }, "hello-world.txt")
+        self.assertEqual(b"".join(response.pop("x-content")), b"Hello, world!\n")
         self.assertEqual(response, {
             "x-status": 200,
-            "x-content": b"Hello, world!\n",
             "accept-ranges": "bytes",
             "content-type": "text/plain",
             "content-length": 14
         })
 
+    def test_streamed(self):
+        app = xhttp.FileServer("tests/data", "text/plain", last_modified=False, etag=False)
+        response = app({ "x-request-method": "GET" }, "hello-world.txt")
+        content = response["x-content"]
+        content.chunk_size = 5
+        self.assertIsInstance(content, xhttp.utils.FileContent)
+        self.assertEqual(len(content), 14)
+        self.assertEqual(list(content), [b"Hello", b", wor", b"ld!\n"])
+
+    def test_range(self):
+        app = xhttp.FileServer("tests/data", "text/plain", last_modified=False, etag=False)
+        response = app({ "x-request-method": "GET", "range": xhttp.headers.RangeHeader("bytes=7-11") }, "hello-world.txt")
+        self.assertEqual(response["x-status"], 206)
+        self.assertEqual(response["x-content"], b"world")
+        self.assertEqual(response["content-range"], "bytes 7-11/14")
+
+    def test_file_wrapper(self):
+        @xhttp.xhttp_app
+        def app(request):
+            return xhttp.utils.serve_file("tests/data/hello-world.txt", "text/plain", last_modified=False)
+        def start_response(status, headers):
+            self.assertEqual(headers, [
+                ("Content-Length", "14"),
+                ("Content-Type", "text/plain")
+            ])
+        environ = gen_environ("GET", "/", {})
+        self.assertIsInstance(app(environ, start_response), xhttp.utils.FileContent)
+        environ["wsgi.file_wrapper"] = lambda f, block_size: (f.read(), block_size)
+        self.assertEqual(app(environ, start_response), (b"Hello, world!\n", 65536))
+
+    def test_not_modified(self):
+        app = xhttp.FileServer("tests/data", "text/plain", last_modified=False, etag="weak")
+        etag = app({ "x-request-method": "GET" }, "hello-world.txt")["etag"]
+        with self.assertRaises(xhttp.exc.HTTPException) as ex:
+            app({ "x-request-method": "GET", "if-none-match": etag }, "hello-world.txt")
+        self.assertEqual(ex.exception.status, 304)
+
     def test_bad_filename(self):
         app = xhttp.FileServer("tests/data", "text/plain", last_modified=False, etag=False)
         with self.assertRaises(xhttp.exc.HTTPException) as ex:
             app({ "x-request-method": "GET" }, "../testxhttp.py")
         self.assertEqual(ex.exception.status, 403)
 
+    def test_precompressed(self):
+        path = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(path, "app.js"), "wb") as f:
+                f.write(b"alert('Hello, world!');\n")
+            with open(os.path.join(path, "app.js.gz"), "wb") as f:
+                f.write(xhttp.utils.gzip_encode(b"alert('Hello, world!');\n"))
+            app = xhttp.FileServer(path, "application/javascript", last_modified=False, precompressed=True)
+
+            request = { "x-request-method": "GET", "accept-encoding": xhttp.headers.QListHeader("br, gzip;q=0.5") }
+            response = app(request, "app.js")
+            self.assertEqual(response["content-encoding"], "gzip")
+            self.assertEqual(response["content-type"], "application/javascript")
+            self.assertEqual(response["vary"], "accept-encoding")
+            self.assertEqual(xhttp.utils.gzip_decode(b"".join(response["x-content"])), b"alert('Hello, world!');\n")
+
+            response = app({ "x-request-method": "GET" }, "app.js")
+            self.assertNotIn("content-encoding", response)
+            self.assertEqual(response["vary"], "accept-encoding")
+            self.assertEqual(b"".join(response["x-content"]), b"alert('Hello, world!');\n")
+
+            # q=0 rules a coding out
+            response = app({ "x-request-method": "GET", "accept-encoding": xhttp.headers.QListHeader("gzip;q=0, identity") }, "app.js")
+            self.assertNotIn("content-encoding", response)
+
+            # a sibling older than the file is stale and isn't served
+            os.utime(os.path.join(path, "app.js.gz"), (0, 0))
+            response = app(request, "app.js")
+            self.assertNotIn("content-encoding", response)
+        finally:
+            shutil.rmtree(path)
+
+    def test_compress(self):
+        app = xhttp.FileServer("tests/data", "text/plain", last_modified=False, etag="weak", compress=True)
+        etag = app({ "x-request-method": "GET" }, "hello-world.txt")["etag"]
+        request = { "x-request-method": "GET", "accept-encoding": xhttp.headers.QListHeader("gzip") }
+
+        # too small to be worth compressing
+        response = app(request, "hello-world.txt")
+        self.assertNotIn("content-encoding", response)
+        self.assertEqual(response["vary"], "accept-encoding")
+
+        xhttp.negotiation.accept_encoding.MIN_SIZE, min_size = 0, xhttp.negotiation.accept_encoding.MIN_SIZE
+        try:
+            response = app(request, "hello-world.txt")
+            self.assertEqual(response["content-encoding"], "gzip")
+            self.assertEqual(response["content-length"], len(response["x-content"]))
+            self.assertEqual(response["etag"], etag[:-1] + '-gzip"')
+            self.assertEqual(xhttp.utils.gzip_decode(response["x-content"]), b"Hello, world!\n")
+            app(request, "hello-world.txt")
+            response = app({ "x-request-method": "GET", "accept-encoding": xhttp.headers.QListHeader("gzip;q=0") }, "hello-world.txt")
+            self.assertNotIn("content-encoding", response)
+            # files too big to compress in memory are sent as they are
+            app.COMPRESS_MAX_SIZE = 10
+            response = app(request, "hello-world.txt")
+            self.assertNotIn("content-encoding", response)
+            self.assertIsInstance(response["x-content"], xhttp.utils.FileContent)
+        finally:
+            xhttp.negotiation.accept_encoding.MIN_SIZE = min_size
+        self.assertEqual(app.cache.stats()["hits"], 1)
+
 #
 # TestAcceptEncoding
 #
@@ -1092,10 +1812,10 @@ class TestAcceptEncoding(unittest.TestCase):
         def app(req):
             return {
                 "x-status": xhttp.status.OK,
-                "x-content": b"Hello, world!\n",
+                "x-content": b"Hello, world!\n" * 20,
                 "content-type": "text/plain"
             }
-        content = xhttp.utils.gzip_encode(b"Hello, world!\n")
+        content = xhttp.utils.gzip_encode(b"Hello, world!\n" * 20, 6)
         res = app({ "accept-encoding": xhttp.headers.QListHeader("gzip,deflate,sdch") })
         self.assertEqual(res, {
             "x-status": 200,
@@ -1105,6 +1825,119 @@ class TestAcceptEncoding(unittest.TestCase):
             "content-encoding": "gzip"
         })
 
+    def test_gzip_streaming(self):
+        @xhttp.accept_encoding
+        def app(req):
+            return {
+                "x-status": xhttp.status.OK,
+                "x-content": [b"Hello,", b" ", b"world!", b"\n"] * 20,
+                "content-type": "text/plain",
+                "content-length": 280
+            }
+        res = app({ "accept-encoding": xhttp.headers.QListHeader("gzip") })
+        content = res.pop("x-content")
+        self.assertEqual(res, {
+            "x-status": 200,
+            "content-type": "text/plain",
+            "content-encoding": "gzip"
+        })
+        self.assertEqual(xhttp.utils.gzip_decode(b"".join(content)), b"Hello, world!\n" * 20)
+
+    def test_gzip_file(self):
+        class eager_accept_encoding(xhttp.accept_encoding):
+            MIN_SIZE = 0
+        app = eager_accept_encoding(xhttp.FileServer("tests/data", "text/plain", last_modified=False))
+        res = app({
+            "x-request-method": "GET",
+            "accept-encoding": xhttp.headers.QListHeader("gzip") }, "hello-world.txt")
+        self.assertFalse("content-length" in res)
+        self.assertEqual(xhttp.utils.gzip_decode(b"".join(res["x-content"])), b"Hello, world!\n")
+
+    def test_not_compressible(self):
+        def app(content_type, content):
+            return xhttp.accept_encoding(lambda req: {
+                "x-status": xhttp.status.OK,
+                "x-content": content,
+                "content-type": content_type
+            })({ "accept-encoding": xhttp.headers.QListHeader("gzip") })
+        self.assertFalse("content-encoding" in app("text/plain", b"x" * 255))
+        self.assertFalse("content-encoding" in app("image/png", b"x" * 1000))
+        self.assertTrue("content-encoding" in app("text/html; charset=UTF-8", b"x" * 1000))
+        self.assertTrue("content-encoding" in app("application/atom+xml", b"x" * 1000))
+        self.assertTrue("content-encoding" in app("application/json", b"x" * 1000))
+
+    def test_content_called_once(self):
+        calls = []
+        def content():
+            calls.append(None)
+            return b"x" * 100
+        app = xhttp.accept_encoding(lambda req: {
+            "x-status": xhttp.status.OK,
+            "x-content": content,
+            "content-type": "text/plain"
+        })
+        # too small to compress
+        res = app({ "accept-encoding": xhttp.headers.QListHeader("gzip") })
+        self.assertEqual(res["x-content"], b"x" * 100)
+        self.assertEqual(len(calls), 1)
+
+    def test_choose_encoding(self):
+        def choose(header):
+            return xhttp.accept_encoding.choose(xhttp.headers.QListHeader(header))
+        self.assertEqual(choose("gzip, deflate"), "gzip")
+        self.assertEqual(choose("deflate, gzip"), "deflate")
+        self.assertEqual(choose("gzip;q=0.5, deflate"), "deflate")
+        self.assertEqual(choose("gzip;q=0, sdch"), None)
+        self.assertEqual(choose("identity, gzip"), None)
+        self.assertEqual(choose("*"), list(xhttp.negotiation.CODECS)[0])
+        self.assertNotEqual(choose("gzip;q=0, *"), "gzip")
+
+        class gzip_only(xhttp.accept_encoding):
+            CODINGS = ["gzip"]
+        self.assertEqual(gzip_only.choose(xhttp.headers.QListHeader("deflate, gzip;q=0.1")), "gzip")
+
+    def test_deflate_encoding(self):
+        class fast_accept_encoding(xhttp.accept_encoding):
+            LEVELS = { "text/*": { "deflate": 1 } }
+        @fast_accept_encoding
+        def app(req):
+            return {
+                "x-status": xhttp.status.OK,
+                "x-content": req["x-content"],
+                "content-type": "text/plain"
+            }
+        res = app({ "accept-encoding": xhttp.headers.QListHeader("gzip;q=0.8, deflate"), "x-content": b"Hello, world!\n" * 20 })
+        self.assertEqual(res["content-encoding"], "deflate")
+        self.assertEqual(res["x-content"], xhttp.utils.deflate_encode(b"Hello, world!\n" * 20, 1))
+        self.assertEqual(res["content-length"], len(res["x-content"]))
+        res = app({ "accept-encoding": xhttp.headers.QListHeader("deflate"), "x-content": [b"Hello, world!\n"] * 20 })
+        self.assertEqual(xhttp.utils.deflate_decode(b"".join(res["x-content"])), b"Hello, world!\n" * 20)
+        self.assertEqual(fast_accept_encoding.level("gzip", "text/html"), 6)
+
+    @unittest.skipUnless("br" in xhttp.negotiation.CODECS, "brotli is not installed")
+    def test_brotli_encoding(self):
+        import brotli
+        app = xhttp.accept_encoding(lambda req: {
+            "x-status": xhttp.status.OK,
+            "x-content": [b"Hello, world!\n"] * 20,
+            "content-type": "text/plain"
+        })
+        res = app({ "accept-encoding": xhttp.headers.QListHeader("br, gzip") })
+        self.assertEqual(res["content-encoding"], "br")
+        self.assertEqual(brotli.decompress(b"".join(res["x-content"])), b"Hello, world!\n" * 20)
+
+    @unittest.skipUnless("zstd" in xhttp.negotiation.CODECS, "zstandard is not installed")
+    def test_zstd_encoding(self):
+        import zstandard
+        app = xhttp.accept_encoding(lambda req: {
+            "x-status": xhttp.status.OK,
+            "x-content": b"Hello, world!\n" * 20,
+            "content-type": "text/plain"
+        })
+        res = app({ "accept-encoding": xhttp.headers.QListHeader("zstd, gzip") })
+        self.assertEqual(res["content-encoding"], "zstd")
+        self.assertEqual(zstandard.ZstdDecompressor().decompress(res["x-content"]), b"Hello, world!\n" * 20)
+
     def test_unacceptable_encoding(self):
         @xhttp.accept_encoding
         def app(req):
@@ -1155,6 +1988,150 @@ class TestRanged(unittest.TestCase):
             "content-range": "bytes 0-4/14"
         })
 
+    def test_suffix_range(self):
+        response = self.app({
+            "x-request-method": "GET",
+            "range": xhttp.headers.RangeHeader("bytes=-7") })
+        self.assertEqual(response["x-content"], "world!\n")
+        self.assertEqual(response["content-range"], "bytes 7-13/14")
+
+    def test_open_range(self):
+        response = self.app({
+            "x-request-method": "GET",
+            "range": xhttp.headers.RangeHeader("bytes=7-") })
+        self.assertEqual(response["x-content"], "world!\n")
+        self.assertEqual(response["content-range"], "bytes 7-13/14")
+
+    def test_unsatisfiable(self):
+        with self.assertRaises(xhttp.exc.HTTPException) as ex:
+            self.app({
+                "x-request-method": "GET",
+                "range": xhttp.headers.RangeHeader("bytes=14-20") })
+        self.assertEqual(ex.exception.status, 416)
+        self.assertEqual(ex.exception.headers["content-range"], "bytes */14")
+
+    def test_multiple_ranges(self):
+        class uncoalesced_ranged(xhttp.ranged):
+            COALESCE_GAP = 0
+        app = uncoalesced_ranged(lambda req: {
+            "x-status": xhttp.status.OK,
+            "x-content": "Hello, world!\n",
+            "content-type": "text/plain" })
+        response = app({ "range": xhttp.headers.RangeHeader("bytes=7-11,0-1") })
+        boundary = response["content-type"].split("boundary=")[1]
+        self.assertEqual(response["x-status"], 206)
+        self.assertEqual(response["content-type"], "multipart/byteranges; boundary=" + boundary)
+        self.assertEqual(response["x-content"], (
+            "\r\n--{0}\r\nContent-Type: text/plain\r\nContent-Range: bytes 0-1/14\r\n\r\nHe"
+            "\r\n--{0}\r\nContent-Type: text/plain\r\nContent-Range: bytes 7-11/14\r\n\r\nworld"
+            "\r\n--{0}--\r\n").format(boundary))
+
+    def test_coalesced_ranges(self):
+        response = self.app({
+            "x-request-method": "GET",
+            "range": xhttp.headers.RangeHeader("bytes=7-9,0-4,3-5,10-11") })
+        self.assertEqual(response["x-content"], "Hello, world")
+        self.assertEqual(response["content-range"], "bytes 0-11/14")
+
+    def test_too_many_ranges(self):
+        class few_ranged(xhttp.ranged):
+            MAX_RANGES = 2
+            COALESCE_GAP = 0
+        app = few_ranged(lambda req: { "x-status": xhttp.status.OK, "x-content": "Hello, world!\n" })
+        response = app({ "range": xhttp.headers.RangeHeader("bytes=0-0,2-2,4-4") })
+        self.assertEqual(response["x-status"], 200)
+        self.assertEqual(response["x-content"], "Hello, world!\n")
+
+    def test_too_many_ranges_called_once(self):
+        calls = []
+        def content():
+            calls.append(None)
+            return b"x" * 10000
+        @xhttp.ranged
+        def app(req):
+            return { "x-status": xhttp.status.OK, "x-content": content }
+        ranges = ",".join("{0}-{0}".format(i * 100) for i in range(20))
+        response = app({ "range": xhttp.headers.RangeHeader("bytes=" + ranges) })
+        self.assertEqual(response["x-status"], 200)
+        self.assertEqual(response["x-content"], b"x" * 10000)
+        self.assertEqual(len(calls), 1)
+
+    def test_multipart_streamed(self):
+        @xhttp.ranged
+        def app(req):
+            return {
+                "x-status": xhttp.status.OK,
+                "x-content": io.BytesIO(b"x" * 1000 + b"y" * 1000),
+                "content-type": "application/octet-stream",
+                "content-length": 2000 }
+        response = app({ "range": xhttp.headers.RangeHeader("bytes=0-9,-10") })
+        content = response["x-content"]
+        self.assertIsInstance(content, xhttp.utils.MultipartRangeContent)
+        body = b"".join(content)
+        self.assertEqual(response["content-length"], len(body))
+        self.assertTrue(b"Content-Range: bytes 1990-1999/2000\r\n\r\nyyyyyyyyyy\r\n" in body)
+
+    def test_seekable(self):
+        for source in [io.BytesIO(b"Hello, world!\n"), mmap.mmap(-1, 14)]:
+            source.write(b"Hello, world!\n")
+            @xhttp.ranged
+            def app(req):
+                return { "x-status": xhttp.status.OK, "x-content": source, "content-length": 14 }
+            response = app({ "range": xhttp.headers.RangeHeader("bytes=7-11") })
+            self.assertEqual(response["x-content"], b"world")
+            self.assertEqual(response["content-length"], 5)
+            self.assertTrue(source.closed)
+
+    def test_streamed_window(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b"".join(bytes(bytearray([i % 256])) * 1024 for i in range(256)))
+            f.flush()
+            app = xhttp.FileServer(os.path.dirname(f.name), "application/octet-stream", last_modified=False)
+            response = app({
+                "x-request-method": "GET",
+                "range": xhttp.headers.RangeHeader("bytes=1000-200999") }, os.path.basename(f.name))
+            self.assertIsInstance(response["x-content"], xhttp.utils.RangeContent)
+            self.assertEqual(response["content-length"], 200000)
+            self.assertEqual(response["content-range"], "bytes 1000-200999/262144")
+            chunks = list(response["x-content"])
+            self.assertEqual(max(len(chunk) for chunk in chunks), 65536)
+            self.assertEqual(b"".join(chunks), open(f.name, "rb").read()[1000:201000])
+
+            # the file is opened once for the whole window
+            opened = []
+            class Content(xhttp.utils.FileContent):
+                def open(self):
+                    opened.append(self.filename)
+                    return xhttp.utils.FileContent.open(self)
+            chunks = list(xhttp.utils.RangeContent(Content(f.name, 262144), 1000, 201000))
+            self.assertEqual(len(chunks), 4)
+            self.assertEqual(b"".join(chunks), open(f.name, "rb").read()[1000:201000])
+            self.assertEqual(opened, [f.name])
+
+    def test_chunked_content(self):
+        @xhttp.ranged
+        def app(req):
+            return { "x-status": xhttp.status.OK, "x-content": [b"Hello, ", b"world!\n"], "content-length": 14 }
+        response = app({ "range": xhttp.headers.RangeHeader("bytes=5-8") })
+        self.assertEqual(response["x-status"], 206)
+        self.assertEqual(response["x-content"], b", wo")
+        self.assertEqual(response["content-range"], "bytes 5-8/14")
+        self.assertEqual(response["content-length"], 4)
+
+    def test_streamed_content(self):
+        class eager_accept_encoding(xhttp.accept_encoding):
+            MIN_SIZE = 0
+        @xhttp.ranged
+        @eager_accept_encoding
+        def app(req):
+            return xhttp.utils.serve_file("tests/data/hello-world.txt", "text/plain", last_modified=False)
+        response = app({
+            "range": xhttp.headers.RangeHeader("bytes=0-9"),
+            "accept-encoding": xhttp.headers.QListHeader("gzip") })
+        self.assertEqual(response["x-status"], 200)
+        self.assertFalse("content-range" in response)
+        self.assertEqual(xhttp.utils.gzip_decode(b"".join(response["x-content"])), b"Hello, world!\n")
+
     def test_no_content(self):
         response = self.app({
             "x-request-method": "POST",
@@ -1189,6 +2166,276 @@ class TestAppCached(unittest.TestCase):
         self.assertEqual(response_5["x-cache"], "MISS")
         self.assertEqual(response_6["x-cache"], "HIT")
 
+    def test_lru(self):
+        @xhttp.app_cached(2)
+        def app(req, key):
+            return { "x-status": xhttp.status.OK, "x-content": key }
+        self.assertEqual(app({}, "a")["x-cache"], "MISS")
+        self.assertEqual(app({}, "b")["x-cache"], "MISS")
+        self.assertEqual(app({}, "a")["x-cache"], "HIT")
+        self.assertEqual(app({}, "c")["x-cache"], "MISS") # evicts b
+        self.assertEqual(app({}, "a")["x-cache"], "HIT")
+        self.assertEqual(app({}, "b")["x-cache"], "MISS")
+        self.assertEqual(app.cache.stats(), {
+            "entries": 2,
+            "bytes": 2,
+            "hits": 2,
+            "misses": 4,
+            "evictions": 2,
+            "expirations": 0
+        })
+
+    def test_max_bytes(self):
+        @xhttp.app_cached(max_bytes=10)
+        def app(req, key):
+            return { "x-status": xhttp.status.OK, "x-content": [b"x" * key] }
+        self.assertEqual(app({}, 4)["x-cache"], "MISS")
+        self.assertEqual(app({}, 5)["x-cache"], "MISS")
+        self.assertEqual(app({}, 4)["x-cache"], "HIT")
+        self.assertEqual(app({}, 6)["x-cache"], "MISS") # evicts 5
+        self.assertEqual(app.cache.bytes, 10)
+        self.assertEqual(app({}, 11)["x-cache"], "MISS") # too big to cache
+        self.assertEqual(app({}, 11)["x-cache"], "MISS")
+        self.assertEqual(app({}, 4)["x-cache"], "HIT")
+
+    def test_max_bytes_streamed(self):
+        produced = []
+        def chunks():
+            for i in range(4):
+                produced.append(i)
+                yield b"x" * 8
+        @xhttp.app_cached(max_bytes=10)
+        def app(req):
+            return { "x-status": xhttp.status.OK, "x-content": chunks() }
+        response = app({})
+        self.assertEqual(response["x-cache"], "MISS")
+        # only as much is read as it takes to know it's too big to cache
+        self.assertEqual(produced, [0, 1])
+        self.assertEqual(b"".join(response["x-content"]), b"x" * 32)
+        self.assertEqual(len(app.cache), 0)
+
+    def test_unknown_size(self):
+        @xhttp.app_cached()
+        def app(req, key):
+            return { "x-status": xhttp.status.OK, "x-content": lambda: [b"x" * key] }
+        self.assertEqual(app.cache.size, 1024)
+        self.assertEqual(app({}, 4)["x-cache"], "MISS")
+        self.assertEqual(app({}, 4)["x-cache"], "MISS")
+        self.assertEqual(len(app.cache), 0)
+
+    def test_ttl(self):
+        @xhttp.app_cached(10, ttl=0)
+        def app(req, key):
+            return { "x-status": xhttp.status.OK }
+        self.assertEqual(app({}, "a")["x-cache"], "MISS")
+        self.assertEqual(app({}, "a")["x-cache"], "MISS")
+        self.assertEqual(app.cache.expirations, 1)
+
+    def test_shared(self):
+        cache = xhttp.cache.LRUCache(10)
+        @xhttp.app_cached(cache=cache)
+        def app1(req, key):
+            return { "x-status": xhttp.status.OK, "x-content": "app1" }
+        @xhttp.app_cached(cache=cache)
+        def app2(req, key):
+            return { "x-status": xhttp.status.OK, "x-content": "app2" }
+        self.assertEqual(app1({}, "a")["x-content"], "app1")
+        self.assertEqual(app2({}, "a")["x-content"], "app2")
+        self.assertEqual(app2({}, "a")["x-cache"], "HIT")
+        self.assertEqual(len(cache), 2)
+
+    def test_vary(self):
+        calls = []
+        @xhttp.app_cached(10)
+        @xhttp.vary("Accept")
+        @xhttp.accept_charset
+        @xhttp.accept
+        def app(req, key):
+            calls.append(key)
+            return {
+                "x-status": xhttp.status.OK,
+                "x-content": { "key": key },
+                "x-content-view": {
+                    "text/plain": lambda m: m["key"] + "\n",
+                    "application/json": lambda m: m
+                }
+            }
+        def get(accept):
+            return app({ "accept": xhttp.headers.QListHeader(accept) }, "a")
+        self.assertEqual(get("text/plain")["x-cache"], "MISS")
+        self.assertEqual(get("application/json")["x-cache"], "MISS")
+        self.assertEqual(get("text/plain")["x-cache"], "MISS")
+        self.assertEqual(get("application/json")["x-cache"], "HIT")
+        response = get("text/plain")
+        self.assertEqual(response["x-cache"], "HIT")
+        self.assertEqual(response["x-content"], b"a\n")
+        self.assertEqual(get("Application/JSON")["x-content"], b'{\n    "key": "a"\n}')
+        self.assertEqual(len(calls), 3)
+
+    def test_compressed_content(self):
+        @xhttp.app_cached(10)
+        @xhttp.vary("Accept-Encoding")
+        @xhttp.accept_encoding
+        def app(req, key):
+            return { "x-status": xhttp.status.OK, "x-content": [b"Hello, world!\n" * 100], "content-type": "text/plain" }
+        req = { "accept-encoding": xhttp.headers.QListHeader("gzip") }
+        # the first response shows the cache what it varies on
+        responses = [ app(req, "a") for _ in range(4) ]
+        self.assertEqual([ response["x-cache"] for response in responses ], ["MISS", "MISS", "HIT", "HIT"])
+        for response in responses:
+            self.assertEqual(response["content-encoding"], "gzip")
+            content = response["x-content"]
+            content = content if isinstance(content, bytes) else b"".join(content)
+            self.assertEqual(xhttp.utils.gzip_decode(content), b"Hello, world!\n" * 100)
+
+    def test_vary_case_sensitive(self):
+        @xhttp.app_cached(10)
+        @xhttp.vary("Cookie")
+        def app(req, key):
+            return { "x-status": xhttp.status.OK, "x-content": req["cookie"].encode("ascii") }
+        self.assertEqual(app({ "cookie": "session=AbC" }, "a")["x-content"], b"session=AbC")
+        self.assertEqual(app({ "cookie": "session=AbC" }, "a")["x-content"], b"session=AbC")
+        response = app({ "cookie": "session=abc" }, "a")
+        self.assertEqual((response["x-cache"], response["x-content"]), ("MISS", b"session=abc"))
+
+    def test_vary_star(self):
+        @xhttp.app_cached(10)
+        @xhttp.vary("*")
+        def app(req, key):
+            return { "x-status": xhttp.status.OK }
+        self.assertEqual(app({}, "a")["x-cache"], "MISS")
+        self.assertEqual(app({}, "a")["x-cache"], "MISS")
+
+class TestCacheBackends(unittest.TestCase):
+    def test_single_flight(self):
+        cache = xhttp.cache.LockedLRUCache(10)
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+        @xhttp.app_cached(cache=cache)
+        def app(req, key):
+            calls.append(key)
+            started.set()
+            release.wait()
+            return { "x-status": xhttp.status.OK, "x-content": key }
+        results = []
+        threads = [ threading.Thread(target=lambda: results.append(app({}, "a"))) for _ in range(5) ]
+        for thread in threads:
+            thread.start()
+        started.wait()
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, ["a"])
+        self.assertEqual(sorted(r["x-cache"] for r in results), ["HIT"] * 4 + ["MISS"])
+        self.assertEqual(app({}, "a")["x-cache"], "HIT")
+
+    def test_single_flight_uncacheable(self):
+        cache = xhttp.cache.LockedLRUCache(10)
+        started = threading.Event()
+        release = threading.Event()
+        # the threads that waited for the first one all compute at once
+        barrier = threading.Barrier(4, timeout=5)
+        calls = []
+        @xhttp.app_cached(cache=cache)
+        def app(req, key):
+            calls.append(key)
+            if len(calls) == 1:
+                started.set()
+                release.wait()
+            else:
+                barrier.wait()
+            return { "x-status": xhttp.status.OK, "x-content": lambda: [key.encode("ascii")] }
+        results = []
+        threads = [ threading.Thread(target=lambda: results.append(app({}, "a"))) for _ in range(5) ]
+        for thread in threads:
+            thread.start()
+        started.wait()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, ["a"] * 5)
+        self.assertEqual([ r["x-cache"] for r in results ], ["MISS"] * 5)
+        self.assertEqual(len(cache), 0)
+
+    def test_single_flight_raises(self):
+        cache = xhttp.cache.LockedLRUCache(10)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        @xhttp.app_cached(cache=cache)
+        def app(req, key):
+            calls.append(key)
+            started.set()
+            release.wait()
+            raise xhttp.exc.HTTPNotImplemented()
+        errors = []
+        def request():
+            try:
+                app({}, "a")
+            except xhttp.exc.HTTPException as e:
+                errors.append(e.status)
+        threads = [ threading.Thread(target=request) for _ in range(5) ]
+        for thread in threads:
+            thread.start()
+        started.wait()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+        # the waiting threads get the exception instead of trying again
+        self.assertEqual(calls, ["a"])
+        self.assertEqual(errors, [501] * 5)
+        self.assertEqual(cache.flights, {})
+
+    def test_single_flight_exception(self):
+        cache = xhttp.cache.LockedLRUCache(10)
+        with self.assertRaises(ZeroDivisionError):
+            cache.fetch("a", lambda: 1 // 0)
+        self.assertEqual(cache.fetch("a", lambda: 1), (1, False))
+        self.assertEqual(cache.flights, {})
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs fork")
+    def test_shared(self):
+        cache = xhttp.cache.SharedCache(slots=16, slot_size=1024)
+        @xhttp.app_cached(cache=cache)
+        def app(req, key):
+            return { "x-status": xhttp.status.OK, "x-content": b"Hello, world!\n" }
+        pid = os.fork()
+        if pid == 0:
+            app({}, "a")
+            os._exit(0)
+        os.waitpid(pid, 0)
+        response = app({}, "a")
+        self.assertEqual(response, {
+            "x-status": 200,
+            "x-content": b"Hello, world!\n",
+            "x-cache": "HIT"
+        })
+        self.assertEqual(cache.stats(), { "hits": 1, "misses": 1, "evictions": 0 })
+
+    def test_shared_too_big(self):
+        cache = xhttp.cache.SharedCache(slots=1, slot_size=64)
+        self.assertFalse(cache.put("a", b"x" * 64))
+        self.assertTrue(cache.put("a", b"x"))
+        self.assertEqual(cache.get("a"), b"x")
+        self.assertTrue(cache.put("b", b"y"))
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.stats()["evictions"], 1)
+        self.assertEqual(len(cache), 1)
+
+    def test_shared_unpicklable(self):
+        cache = xhttp.cache.SharedCache(slots=4, slot_size=1024)
+        self.assertFalse(cache.put("a", (x for x in "abc")))
+        self.assertFalse(cache.put("a", lambda: None))
+        self.assertEqual(cache.get("a"), None)
+        @xhttp.app_cached(cache=cache)
+        def app(req, key):
+            return { "x-status": xhttp.status.OK, "x-content": b"hello", "x-render": lambda: None }
+        self.assertEqual(app({}, "a")["x-cache"], "MISS")
+        self.assertEqual(app({}, "a")["x-cache"], "MISS")
+
 class TestCacheControl(unittest.TestCase):
     @xhttp.cache_control('must-revalidate')
     @staticmethod
@@ -1219,5 +2466,172 @@ class TestRedirector(unittest.TestCase):
             'location': '/test',
             'x-detail': '/test' })
 
+#
+# TestServer
+#
+
+def pid_app(environ, start_response):
+    body = "{0} {1} {2} {3}".format(os.getpid(), environ["REQUEST_URI"], environ["DOCUMENT_ROOT"],
+                                    len(environ["wsgi.input"].read(min(1, int(environ.get("CONTENT_LENGTH") or 0))))).encode("ascii")
+    start_response("200 OK", [("Content-Length", str(len(body))), ("Content-Type", "text/plain")])
+    return [body]
+
+class TestServer(unittest.TestCase):
+    def test_keep_alive(self):
+        server = xhttp.server.make_server("127.0.0.1", 0, xhttp.server.fix_wsgiref(pid_app, "/srv"),
+                                          threads=2, keep_alive=True, timeout=5)
+        server.RequestHandlerClass.log_request = lambda *a, **k: None
+        state = { "stop": None }
+        thread = threading.Thread(target=server.serve, args=(state,))
+        thread.start()
+        try:
+            conn = httplib.HTTPConnection("127.0.0.1", server.server_port, timeout=5)
+            # the body the app leaves unread is skipped before the next request
+            conn.request("POST", "/a?b=c", body=b"x" * 100000)
+            sock = conn.sock
+            self.assertEqual(conn.getresponse().read(), "{0} /a?b=c /srv 1".format(os.getpid()).encode("ascii"))
+            conn.request("GET", "/d")
+            self.assertEqual(conn.getresponse().read(), "{0} /d /srv 0".format(os.getpid()).encode("ascii"))
+            self.assertIs(conn.sock, sock)
+            conn.close()
+        finally:
+            state["stop"] = "exit"
+            thread.join()
+            server.server_close()
+
+    def test_keep_alive_chunked(self):
+        @xhttp.xhttp_app
+        @xhttp.catcher
+        @xhttp.post({ "spam": "^.*$" })
+        def app(req):
+            return { "x-status": xhttp.status.OK, "x-content": req["x-post"]["spam"].encode("ascii") }
+        server = xhttp.server.make_server("127.0.0.1", 0, xhttp.server.fix_wsgiref(app), threads=2, keep_alive=True, timeout=5)
+        server.RequestHandlerClass.log_request = lambda *a, **k: None
+        state = { "stop": None }
+        thread = threading.Thread(target=server.serve, args=(state,))
+        thread.start()
+        try:
+            conn = httplib.HTTPConnection("127.0.0.1", server.server_port, timeout=5)
+            socks = []
+            for _ in range(2):
+                conn.putrequest("POST", "/")
+                conn.putheader("Transfer-Encoding", "chunked")
+                conn.endheaders()
+                conn.send(b"7\r\nspam=al\r\n7\r\nbatross\r\n0\r\n\r\n")
+                response = conn.getresponse()
+                self.assertEqual((response.status, response.read()), (200, b"albatross"))
+                socks.append(conn.sock)
+            # the connection was kept alive
+            self.assertIs(socks[0], socks[1])
+            conn.close()
+        finally:
+            state["stop"] = "exit"
+            thread.join()
+            server.server_close()
+
+    def test_bad_chunks(self):
+        @xhttp.xhttp_app
+        @xhttp.accept_charset
+        @xhttp.catcher
+        @xhttp.post({ "spam": "^.*$" })
+        def app(req):
+            return { "x-status": xhttp.status.OK, "x-content": req["x-post"]["spam"].encode("ascii") }
+        server = xhttp.server.make_server("127.0.0.1", 0, xhttp.server.fix_wsgiref(app), threads=2, keep_alive=True, timeout=5)
+        server.RequestHandlerClass.log_request = lambda *a, **k: None
+        state = { "stop": None }
+        thread = threading.Thread(target=server.serve, args=(state,))
+        thread.start()
+        try:
+            for body in [b"zz\r\nspam=albatross\r\n0\r\n\r\n", b"20\r\nspam=al"]:
+                conn = httplib.HTTPConnection("127.0.0.1", server.server_port, timeout=5)
+                conn.putrequest("POST", "/")
+                conn.putheader("Transfer-Encoding", "chunked")
+                conn.endheaders()
+                conn.send(body)
+                if body.endswith(b"al"):
+                    conn.sock.shutdown(socket.SHUT_WR)
+                self.assertEqual(conn.getresponse().status, 400)
+                conn.close()
+        finally:
+            state["stop"] = "exit"
+            thread.join()
+            server.server_close()
+
+    def test_idle_nonblocking(self):
+        # pre-forked workers share a non-blocking socket; while there are no
+        # connections they should wait for one, not keep trying to accept
+        server = xhttp.server.make_server("127.0.0.1", 0, xhttp.server.fix_wsgiref(pid_app, "/srv"))
+        server.RequestHandlerClass.log_request = lambda *a, **k: None
+        server.socket.setblocking(False)
+        accepts = []
+        get_request = server.get_request
+        def counted_get_request():
+            accepts.append(None)
+            return get_request()
+        server.get_request = counted_get_request
+        state = { "stop": None }
+        thread = threading.Thread(target=server.serve, args=(state,))
+        thread.start()
+        try:
+            time.sleep(1)
+            self.assertEqual(accepts, [])
+            conn = httplib.HTTPConnection("127.0.0.1", server.server_port, timeout=5)
+            conn.request("GET", "/a")
+            self.assertEqual(conn.getresponse().read(), "{0} /a /srv 0".format(os.getpid()).encode("ascii"))
+            conn.close()
+            self.assertEqual(len(accepts), 1)
+        finally:
+            state["stop"] = "exit"
+            thread.join()
+            server.server_close()
+
+    @unittest.skipUnless(hasattr(os, "fork") and hasattr(signal, "SIGHUP"), "needs fork and SIGHUP")
+    def test_prefork_reload(self):
+        s = socket.socket()
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+        s.close()
+        script = "import sys, xhttp, test_xhttp; xhttp.run_server(test_xhttp.pid_app, '127.0.0.1', {0}, processes=2)".format(port)
+        environ = dict(os.environ, PYTHONPATH=os.pathsep.join([os.getcwd(), os.path.dirname(__file__), os.environ.get("PYTHONPATH", "")]))
+        proc = subprocess.Popen([sys.executable, "-c", script], stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=environ)
+        def pids():
+            result = set()
+            for _ in range(8):
+                conn = httplib.HTTPConnection("127.0.0.1", port, timeout=5)
+                conn.request("GET", "/")
+                result.add(conn.getresponse().read().split()[0])
+                conn.close()
+            return result
+        try:
+            self.assertTrue(proc.stdout.readline().startswith(b"Serving on"))
+            before = pids()
+            self.assertNotIn(str(proc.pid).encode("ascii"), before)
+            proc.send_signal(signal.SIGHUP)
+            self.assertTrue(proc.stdout.readline().startswith(b"Serving on"))
+            after = pids()
+            self.assertFalse(before & after)
+            proc.send_signal(signal.SIGTERM)
+            self.assertEqual(proc.wait(), 0)
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+            proc.stdout.close()
+            proc.stderr.close()
+
+#
+# TestImport
+#
+
+class TestImport(unittest.TestCase):
+    @unittest.skipUnless(sys.version_info >= (3, 7), "needs module __getattr__")
+    def test_lazy(self):
+        script = ("import sys, xhttp; "
+                  "print(sorted(m for m in ('asyncio', 'socketserver', 'orjson') if m in sys.modules)); "
+                  "xhttp.run_server, xhttp.xhttp_asgi_app; "
+                  "print('asyncio' in sys.modules, 'socketserver' in sys.modules)")
+        environ = dict(os.environ, PYTHONPATH=os.pathsep.join([os.getcwd(), os.environ.get("PYTHONPATH", "")]))
+        output = subprocess.check_output([sys.executable, "-c", script], env=environ)
+        self.assertEqual(output.split(b"\n"), [b"[]", b"True True", b""])
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,6 +1,7 @@
 from __future__ import division, absolute_import, print_function
 
 import collections
+import importlib
 import sys
 
 if sys.version_info[0] == 2:
@@ -14,6 +15,7 @@ if sys.version_info[0] == 2:
 from . import headers # pragma: no flakes
 from . import exc # pragma: no flakes
 from . import utils # pragma: no flakes
+from . import cache # pragma: no flakes
 from . import types # pragma: no flakes
 from . import forms # pragma: no flakes
 from . import negotiation # pragma: no flakes
@@ -22,9 +24,9 @@ from . import decorators # pragma: no flakes
 
 from .types import Resource, Router, FileServer, Redirector # pragma: no flakes
 
-from .forms import get, post, cookie # pragma: no flakes
+from .forms import get, post, cookie, multipart, json_body # pragma: no flakes
 from .negotiation import custom_accept, accept, accept_encoding, accept_charset # pragma: no flakes
-from .conditional import if_modified_since, if_none_match, ranged # pragma: no flakes
+from .conditional import validators, if_modified_since, if_none_match, ranged # pragma: no flakes
 from .decorators import catcher, session, cache_control, vary, app_cached # pragma: no flakes
 
 __author__ = 'Joost Molenaar <j.j.molenaar@gmail.com>'
@@ -38,19 +40,18 @@ __author__ = 'Joost Molenaar <j.j.molenaar@gmail.com>'
 #
 
 class xhttp_app(utils.decorator):
-    def parse_request(self, environment):
-        request = { name[5:].lower().replace('_', '-'): value 
-                    for (name, value) in environment.items() 
-                    if name.startswith("HTTP_") }
-
-        request.update({ target: getter(environment)
-                         for (target, getter) in self.ENVIRONMENT.items() })
+    # Set SORT_HEADERS to False to send headers in dictionary order. A
+    # handler that sends the same headers every time can serialize them
+    # once with serialize_headers() and return them as x-headers; any other
+    # headers in the response are added to those, replacing any of the same
+    # name.
+    SORT_HEADERS = True
 
-        request.update({ name: parse(request[name])
-                         for (name, parse) in self.PARSERS.items()
-                         if name in request })
+    STATUS_LINES = { code: "{0} {1}".format(code, reason) for (code, reason) in status.responses.items() }
+    HEADER_NAMES = {}
 
-        return request
+    def parse_request(self, environment):
+        return utils.LazyRequest(environment, self.ENVIRONMENT, self.PARSERS)
 
     def create_content(self, response):
         content = response.pop("x-content", b"")
@@ -63,19 +64,52 @@ class xhttp_app(utils.decorator):
             content = [content]
         return content
 
+    @classmethod
+    def status_line(cls, code):
+        try:
+            return cls.STATUS_LINES[code]
+        except KeyError:
+            return "{0} {1}".format(code, status.responses[code])
+
+    @classmethod
+    def serialize_headers(cls, response, sort=True):
+        header_type = str if sys.version_info[0] == 3 else bytes
+        names = cls.HEADER_NAMES
+        headers = []
+        for key in (sorted(response.keys()) if sort else response.keys()):
+            try:
+                name = names[key]
+            except KeyError:
+                name = key.title()
+                if len(names) < 1024:
+                    names[key] = name
+            value = response[key]
+            headers.append((name, value if type(value) is header_type else header_type(value)))
+        return headers
+
+    @classmethod
+    def merge_headers(cls, preserialized, headers):
+        # a new list, since servers may add to the list they're given
+        if not headers:
+            return list(preserialized)
+        names = set(name.lower() for (name, _) in headers)
+        return [ header for header in preserialized if header[0].lower() not in names ] + headers
+
     def __call__(self, environment, start_response):
         request = self.parse_request(environment)
 
         response = self.func(request)
 
-        response_code = response.pop("x-status")
-        response_code = "{0} {1}".format(response_code, status.responses[response_code])
+        response_code = self.status_line(response.pop("x-status"))
+        preserialized = response.pop("x-headers", None)
 
         content = self.create_content(response)
+        if isinstance(content, utils.FileContent) and "wsgi.file_wrapper" in environment:
+            content = environment["wsgi.file_wrapper"](content.open(), content.chunk_size)
 
-        header_type = str if sys.version_info[0] == 3 else bytes
-        headers = [ (key.title(), header_type(response[key]))
-                    for key in sorted(response.keys()) ]
+        headers = self.serialize_headers(response, self.SORT_HEADERS)
+        if preserialized is not None:
+            headers = self.merge_headers(preserialized, headers)
 
         start_response(response_code, headers)
         return content
@@ -102,10 +136,38 @@ class xhttp_app(utils.decorator):
         "x-server-name"    : lambda env: env.get("SERVER_NAME", None),
         "x-server-port"    : lambda env: env.get("SERVER_PORT", None),
         "x-server-protocol": lambda env: env.get("SERVER_PROTOCOL", None),
-        "x-wsgi-input"     : lambda env: env.get("wsgi.input", None)
+        "x-wsgi-input"     : lambda env: env.get("wsgi.input", None),
+        "x-wsgi-input-terminated": lambda env: env.get("wsgi.input_terminated", False)
         #x-env"            : lambda env: env
     }
         
+#
+# server/asgi
+#
+
+# server and asgi pull in socketserver and asyncio, which an app that's only
+# imported by a WSGI server never uses, so they're imported on first access
+LAZY = {
+    "server"         : ("server", None),
+    "run_server"     : ("server", "run_server"),
+    "asgi"           : ("asgi", None),
+    "xhttp_asgi_app" : ("asgi", "xhttp_asgi_app")
+}
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        try:
+            module, attribute = LAZY[name]
+        except KeyError:
+            raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+        module = importlib.import_module("." + module, __name__)
+        return module if attribute is None else getattr(module, attribute)
+else:
+    from . import server # pragma: no flakes
+    from .server import run_server # pragma: no flakes
+    if sys.version_info[0] == 3:
+        from .asgi import xhttp_asgi_app # pragma: no flakes
+
 #
 # class WSGIAdapter
 #
@@ -137,30 +199,3 @@ def extended_with(C):
             new_class = super(extended_with, cls).__new__(cls, name, bases, attrs)
             return new_class
     return extended_with
-
-
-#
-# run_server
-#
-
-def run_server(app, ip='', port=8000):
-    def fix_wsgiref(app):
-        def fixed_app(environ, start_response):
-            # add REQUEST_URI
-            if 'REQUEST_URI' not in environ:
-                environ['REQUEST_URI'] = environ['PATH_INFO']
-                if environ['QUERY_STRING']:
-                    environ['REQUEST_URI'] += '?'
-                    environ['REQUEST_URI'] += environ['QUERY_STRING']
-            # add DOCUMENT_ROOT
-            import os
-            environ['DOCUMENT_ROOT'] = os.getcwd()
-            # do it
-            return app(environ, start_response)
-        return fixed_app
-
-    app = fix_wsgiref(app)
-    print('Serving on {0}:{1}'.format(ip, port))
-    import wsgiref.simple_server
-    wsgiref.simple_server.make_server(ip, port, app).serve_forever()
-
@@ -0,0 +1,154 @@
+import asyncio
+import inspect
+import io
+
+from . import exc
+from . import xhttp_app
+
+__all__ = [ 'xhttp_asgi_app' ]
+
+#
+# then_async
+#
+
+async def then_async(awaitable, callback, errback):
+    try:
+        result = await awaitable
+    except Exception as e:
+        if errback is None:
+            raise
+        return errback(e)
+    return callback(result) if callback else result
+
+#
+# @xhttp_asgi_app
+#
+
+class xhttp_asgi_app(xhttp_app):
+    # Serves the same handlers as @xhttp_app over ASGI. The request is built
+    # from the scope as if it came from a WSGI environment, with the body
+    # read up front into x-wsgi-input. Handlers may be async defs, and
+    # x-content may be an async iterable, which is sent as it's produced.
+    # Handlers are called, and other iterable content is read, in a worker
+    # thread, since a sync handler or reading a file would block the event
+    # loop; what an async handler returns is awaited on the loop.
+
+    # bodies bigger than this are refused with a 413 (None for no limit),
+    # since they're held in memory
+    MAX_BODY_SIZE = 1024 * 1024
+
+    def environment(self, scope, body):
+        root_path = scope.get("root_path", "")
+        path = scope["path"]
+        query_string = scope.get("query_string", b"").decode("latin-1")
+        environment = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": root_path,
+            "PATH_INFO": path[len(root_path):] if path.startswith(root_path) else path,
+            "QUERY_STRING": query_string,
+            "REQUEST_URI": path + ("?" + query_string if query_string else ""),
+            "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.input_terminated": True,
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "asgi.scope": scope
+        }
+        if scope.get("server"):
+            environment["SERVER_NAME"], environment["SERVER_PORT"] = scope["server"][0], str(scope["server"][1])
+        if scope.get("client"):
+            environment["REMOTE_ADDR"], environment["REMOTE_PORT"] = scope["client"][0], str(scope["client"][1])
+        for (name, value) in scope.get("headers", []):
+            name = name.decode("latin-1").upper().replace("-", "_")
+            name = name if name in ("CONTENT_TYPE", "CONTENT_LENGTH") else ("HTTP_" + name)
+            value = value.decode("latin-1")
+            environment[name] = (environment[name] + "," + value) if name in environment else value
+        return environment
+
+    async def read_body(self, scope, receive):
+        # the body, or None if the client went away before sending all of it
+        limit = self.MAX_BODY_SIZE
+        if limit is not None:
+            for (name, value) in scope.get("headers", []):
+                if name.lower() == b"content-length" and value.strip().isdigit() and int(value) > limit:
+                    raise exc.HTTPRequestEntityTooLarge(detail="Body is larger than {0} bytes".format(limit))
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return None
+            chunks.append(message.get("body", b""))
+            size += len(chunks[-1])
+            if limit is not None and size > limit:
+                raise exc.HTTPRequestEntityTooLarge(detail="Body is larger than {0} bytes".format(limit))
+            if not message.get("more_body", False):
+                break
+        return b"".join(chunks)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({ "type": "lifespan.startup.complete" })
+            elif message["type"] == "lifespan.shutdown":
+                await send({ "type": "lifespan.shutdown.complete" })
+                return
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            raise ValueError("Unsupported scope type {0!r}".format(scope["type"]))
+
+        try:
+            body = await self.read_body(scope, receive)
+        except exc.HTTPException as e:
+            response = e.response()
+            response["x-content"] = response["x-content"].encode("utf-8")
+        else:
+            if body is None:
+                # nobody to answer, and the request isn't complete
+                return
+            request = self.parse_request(self.environment(scope, body))
+            response = await asyncio.get_running_loop().run_in_executor(None, self.func, request)
+            if inspect.isawaitable(response):
+                response = await response
+
+        response_code = int(response.pop("x-status"))
+        preserialized = response.pop("x-headers", None)
+
+        content = response.pop("x-content", b"")
+        if not hasattr(content, "__aiter__"):
+            response["x-content"] = content
+            content = self.create_content(response)
+
+        headers = self.serialize_headers(response, self.SORT_HEADERS)
+        if preserialized is not None:
+            headers = self.merge_headers(preserialized, headers)
+
+        await send({
+            "type": "http.response.start",
+            "status": response_code,
+            "headers": [ (name.lower().encode("latin-1"), value.encode("latin-1")) for (name, value) in headers ]
+        })
+        try:
+            if hasattr(content, "__aiter__"):
+                async for chunk in content:
+                    await send({ "type": "http.response.body", "body": chunk, "more_body": True })
+            elif isinstance(content, (list, tuple)):
+                for chunk in content:
+                    await send({ "type": "http.response.body", "body": chunk, "more_body": True })
+            else:
+                loop = asyncio.get_running_loop()
+                chunks = iter(content)
+                while True:
+                    chunk = await loop.run_in_executor(None, next, chunks, None)
+                    if chunk is None:
+                        break
+                    await send({ "type": "http.response.body", "body": chunk, "more_body": True })
+            await send({ "type": "http.response.body", "body": b"", "more_body": False })
+        finally:
+            if hasattr(content, "aclose"):
+                await content.aclose()
+            elif hasattr(content, "close"):
+                content.close()
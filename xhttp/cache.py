@@ -0,0 +1,258 @@
+import collections
+import hashlib
+import mmap
+import pickle
+import struct
+import threading
+import time
+
+__all__ = [ 'LRUCache', 'LockedLRUCache', 'SharedCache' ]
+
+clock = getattr(time, "monotonic", time.time)
+
+MISSING = object()
+
+#
+# LRUCache
+#
+
+class LRUCache(object):
+    def __init__(self, size=None, ttl=None, max_bytes=None):
+        self.size = size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        try:
+            value, expires, nbytes = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires is not None and expires <= clock():
+            self.bytes -= nbytes
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self.entries[key] = (value, expires, nbytes)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, ttl=None, nbytes=0):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[2]
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            return False
+        ttl = self.ttl if ttl is None else ttl
+        self.entries[key] = (value, clock() + ttl if ttl is not None else None, nbytes)
+        self.bytes += nbytes
+        while ((self.size is not None and len(self.entries) > self.size)
+               or (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            _, (_, _, evicted) = self.entries.popitem(last=False)
+            self.bytes -= evicted
+            self.evictions += 1
+        return True
+
+    def fetch(self, key, compute, ttl=None, sizeof=None, cacheable=None):
+        value = self.get(key, MISSING)
+        if value is not MISSING:
+            return (value, True)
+        value = compute()
+        if cacheable is None or cacheable(value):
+            self.put(key, value, ttl=ttl, nbytes=sizeof(value) if sizeof else 0)
+        return (value, False)
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+#
+# LockedLRUCache
+#
+
+class _Flight(object):
+    # the outcome of computing a value that other threads are waiting for
+    __slots__ = [ 'done', 'value', 'error', 'uncacheable' ]
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = MISSING
+        self.error = None
+        self.uncacheable = False
+
+class LockedLRUCache(LRUCache):
+    def __init__(self, size=None, ttl=None, max_bytes=None):
+        super(LockedLRUCache, self).__init__(size, ttl=ttl, max_bytes=max_bytes)
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def get(self, key, default=None):
+        with self.lock:
+            return super(LockedLRUCache, self).get(key, default)
+
+    def put(self, key, value, ttl=None, nbytes=0):
+        with self.lock:
+            return super(LockedLRUCache, self).put(key, value, ttl=ttl, nbytes=nbytes)
+
+    def fetch(self, key, compute, ttl=None, sizeof=None, cacheable=None):
+        # concurrent misses for one key wait for the first thread to compute
+        # the value, rather than all computing it at once; they get what it
+        # computed, or the exception it raised, and only compute it after
+        # all when it turned out not to be cacheable
+        while True:
+            with self.lock:
+                value = LRUCache.get(self, key, MISSING)
+                if value is not MISSING:
+                    return (value, True)
+                flight = self.flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self.flights[key] = _Flight()
+            if leader:
+                break
+            flight.done.wait()
+            if flight.value is not MISSING:
+                return (flight.value, True)
+            if flight.error is not None:
+                raise flight.error
+            if flight.uncacheable:
+                return (compute(), False)
+
+        try:
+            value = compute()
+            if cacheable is None or cacheable(value):
+                flight.value = value
+                self.put(key, value, ttl=ttl, nbytes=sizeof(value) if sizeof else 0)
+            else:
+                flight.uncacheable = True
+            return (value, False)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+    def clear(self):
+        with self.lock:
+            super(LockedLRUCache, self).clear()
+
+    def stats(self):
+        with self.lock:
+            return super(LockedLRUCache, self).stats()
+
+#
+# SharedCache
+#
+
+class SharedCache(object):
+    # Direct-mapped cache of pickled values in anonymous shared memory. When
+    # created before forking, all worker processes read and write the same
+    # slots. A key maps to a single slot; storing a key evicts whatever was
+    # there. Values that don't fit in a slot aren't stored.
+
+    COUNTERS = struct.Struct("!QQQ")
+    SLOT = struct.Struct("!8sdI")
+
+    def __init__(self, slots=1024, slot_size=65536, ttl=None):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.ttl = ttl
+        # imported here, since it's slow to import and only needed here
+        import multiprocessing
+        self.lock = multiprocessing.Lock()
+        self.memory = mmap.mmap(-1, self.COUNTERS.size + slots * slot_size)
+
+    def __len__(self):
+        with self.lock:
+            return sum(1 for i in range(self.slots)
+                       if self.SLOT.unpack_from(self.memory, self.offset(i))[2])
+
+    def offset(self, index):
+        return self.COUNTERS.size + index * self.slot_size
+
+    def locate(self, key):
+        digest = hashlib.sha1(pickle.dumps(key, 2)).digest()[:8]
+        return (digest, self.offset(struct.unpack("!Q", digest)[0] % self.slots))
+
+    def count(self, hits=0, misses=0, evictions=0):
+        counters = self.COUNTERS.unpack_from(self.memory, 0)
+        self.COUNTERS.pack_into(self.memory, 0, counters[0] + hits, counters[1] + misses, counters[2] + evictions)
+
+    def get(self, key, default=None):
+        digest, offset = self.locate(key)
+        with self.lock:
+            slot_digest, expires, length = self.SLOT.unpack_from(self.memory, offset)
+            if not length or slot_digest != digest or (expires and expires <= clock()):
+                self.count(misses=1)
+                return default
+            start = offset + self.SLOT.size
+            data = self.memory[start:start+length]
+            self.count(hits=1)
+        return pickle.loads(data)
+
+    def put(self, key, value, ttl=None, nbytes=0):
+        # values that can't be pickled (generators, lambdas, open files) or
+        # don't fit in a slot are left out, like values a bounded cache drops
+        try:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return False
+        if self.SLOT.size + len(data) > self.slot_size:
+            return False
+        ttl = self.ttl if ttl is None else ttl
+        digest, offset = self.locate(key)
+        with self.lock:
+            slot_digest, _, length = self.SLOT.unpack_from(self.memory, offset)
+            if length and slot_digest != digest:
+                self.count(evictions=1)
+            self.SLOT.pack_into(self.memory, offset, digest, clock() + ttl if ttl is not None else 0, len(data))
+            start = offset + self.SLOT.size
+            self.memory[start:start+len(data)] = data
+        return True
+
+    def fetch(self, key, compute, ttl=None, sizeof=None, cacheable=None):
+        value = self.get(key, MISSING)
+        if value is not MISSING:
+            return (value, True)
+        value = compute()
+        if cacheable is None or cacheable(value):
+            self.put(key, value, ttl=ttl)
+        return (value, False)
+
+    def clear(self):
+        with self.lock:
+            self.memory[:] = b"\0" * len(self.memory)
+
+    def stats(self):
+        with self.lock:
+            hits, misses, evictions = self.COUNTERS.unpack_from(self.memory, 0)
+        return {
+            "hits": hits,
+            "misses": misses,
+            "evictions": evictions
+        }
@@ -1,14 +1,47 @@
 import sys
+import uuid
 
 from . import exc
-from .utils import decorator
+from .utils import decorator, then, content_length, read_range, RangeContent, MultipartRangeContent, CHUNK_SIZE
 
 if sys.version_info[0] == 2:
     import httplib as status
 elif sys.version_info[0] == 3:
     import http.client as status
 
-__all__ = ['if_modified_since', 'if_none_match', 'ranged']
+if sys.version_info[0] == 2:
+    bytes, str = str, unicode # pragma: no flakes
+
+__all__ = ['validators', 'if_modified_since', 'if_none_match', 'ranged']
+
+#
+# @validators
+#
+
+def validators(etag=None, last_modified=None):
+    # attach cheap callables taking the same arguments as the handler, which
+    # @if_none_match and @if_modified_since try before running the handler
+    def set_validators(func):
+        if etag is not None:
+            func.etag = etag
+        if last_modified is not None:
+            func.last_modified = last_modified
+        return func
+    return set_validators
+
+def _find_validator(func, name):
+    # look for the validator down the stack of decorators, binding it to the
+    # resource when the handler is a method; the bound method is at the
+    # bottom of the stack, which may be below the validator
+    validator = None
+    while func is not None:
+        if validator is None:
+            validator = getattr(func, name, None)
+        owner = getattr(func, "__self__", None)
+        if validator is not None and owner is not None:
+            return validator.__get__(owner, type(owner))
+        func = getattr(func, "func", None)
+    return validator
 
 #
 # @if_modified_since
@@ -16,7 +49,13 @@ __all__ = ['if_modified_since', 'if_none_match', 'ranged']
 
 class if_modified_since(decorator):
     def __call__(self, req, *a, **k):
-        res = self.func(req, *a, **k)
+        if "if-modified-since" in req:
+            last_modified = _find_validator(self.func, "last_modified")
+            if last_modified and not req["if-modified-since"] < last_modified(req, *a, **k):
+                raise exc.HTTPNotModified()
+        return then(lambda: self.func(req, *a, **k), lambda res: self.check(req, res))
+
+    def check(self, req, res):
         if "if-modified-since" not in req:
             return res
         if "last-modified" not in res:
@@ -33,7 +72,13 @@ class if_modified_since(decorator):
 
 class if_none_match(decorator):
     def __call__(self, req, *a, **k):
-        res = self.func(req, *a, **k)
+        if "if-none-match" in req:
+            etag = _find_validator(self.func, "etag")
+            if etag and req["if-none-match"] == etag(req, *a, **k):
+                raise exc.HTTPNotModified()
+        return then(lambda: self.func(req, *a, **k), lambda res: self.check(req, res))
+
+    def check(self, req, res):
         if "if-none-match" not in req:
             return res
         if "etag" not in res:
@@ -48,25 +93,82 @@ class if_none_match(decorator):
 # @ranged
 #
 
+def _window(start, stop, length):
+    # inclusive byte window for a range, or None when it can't be satisfied
+    if start is None:
+        return (max(length - stop, 0), length - 1) if (stop and length) else None
+    if start >= length:
+        return None
+    return (start, length - 1 if (stop is None or stop >= length) else stop)
+
+def _coalesce(windows, gap):
+    merged = []
+    for (start, stop) in sorted(windows):
+        if merged and start <= merged[-1][1] + 1 + gap:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
 class ranged(decorator):
+    # ranges closer together than the overhead of a part are merged; if more
+    # than MAX_RANGES remain, the whole content is sent instead
+    MAX_RANGES = 16
+    COALESCE_GAP = 80
+
     def __call__(self, req, *a, **k):
-        res = self.func(req, *a, **k)
+        return then(lambda: self.func(req, *a, **k), lambda res: self.select(req, res))
+
+    def select(self, req, res):
         res.update({ "accept-ranges": "bytes" })
         if "range" not in req:
             return res
         if "x-content" not in res:
             return res
+        ranges = req["range"].ranges
+        if any(start is not None and stop is not None and start > stop for (start, stop) in ranges):
+            return res
         content = res["x-content"]
         if callable(content):
-            content = content()
-        length = len(content)
-        start = req["range"].start
-        stop = req["range"].stop if req["range"].stop is not None else (length - 1)
-        content = content[start:stop+1]
-        res.update({
-            "x-status": status.PARTIAL_CONTENT,
-            "x-content": content,
-            "content-range": "bytes {0}-{1}/{2}".format(start, stop, length)
-        })
+            # called once; what it made is sent whole if it can't be ranged
+            content = res["x-content"] = content()
+        if isinstance(content, (list, tuple)):
+            # chunks that are already in memory are cut as one string
+            content = content[0][:0].join(content) if content else b""
+        length = content_length(content)
+        if length is None:
+            # a stream, like compressed content, is sent whole
+            return res
+        windows = [ w for w in (_window(start, stop, length) for (start, stop) in ranges) if w ]
+        if not windows:
+            raise exc.HTTPRequestedRangeNotSatisfiable(length)
+        windows = _coalesce(windows, self.COALESCE_GAP) if len(windows) > 1 else windows
+        if len(windows) > self.MAX_RANGES:
+            return res
+        if len(windows) == 1:
+            start, stop = windows[0]
+            if isinstance(content, (bytes, str)) or stop + 1 - start <= CHUNK_SIZE:
+                source, content = content, read_range(content, start, stop + 1)
+                # the source isn't sent, so it isn't closed after sending
+                if hasattr(source, "close"):
+                    source.close()
+            else:
+                content = RangeContent(content, start, stop + 1)
+            res.update({
+                "x-status": status.PARTIAL_CONTENT,
+                "x-content": content,
+                "content-range": "bytes {0}-{1}/{2}".format(start, stop, length)
+            })
+        else:
+            boundary = uuid.uuid4().hex
+            content = MultipartRangeContent(content, windows, length, res.get("content-type"), boundary)
+            if isinstance(content.source, (bytes, str)):
+                content = content.source[:0].join(content)
+            res.update({
+                "x-status": status.PARTIAL_CONTENT,
+                "x-content": content,
+                "content-type": "multipart/byteranges; boundary={0}".format(boundary)
+            })
+        if "content-length" in res:
+            res["content-length"] = len(content)
         return res
-
@@ -1,7 +1,13 @@
+import itertools
+import sys
 import traceback
 
 from . import exc
-from .utils import decorator
+from .cache import LRUCache
+from .utils import decorator, then
+
+if sys.version_info[0] == 2:
+    bytes, str = str, unicode # pragma: no flakes
 
 __all__ = ['catcher', 'session', 'cache_control', 'vary', 'app_cached']
 
@@ -11,18 +17,15 @@ __all__ = ['catcher', 'session', 'cache_control', 'vary', 'app_cached']
 
 class catcher(decorator):
     def __call__(self, req, *a, **k):
-        try:
-            try:
-                return self.func(req, *a, **k)
-            except Exception as e:
-                if isinstance(e, exc.HTTPException):
-                    raise
-                print("")
-                traceback.print_exc()
-                detail = "{0} ({1})".format(type(e).__name__, e.args[0])
-                raise exc.HTTPInternalServerError(detail=detail)
-        except exc.HTTPException as e:
-            return e.response()
+        return then(lambda: self.func(req, *a, **k), None, self.catch)
+
+    def catch(self, e):
+        if not isinstance(e, exc.HTTPException):
+            print("")
+            traceback.print_exc()
+            detail = "{0} ({1})".format(type(e).__name__, e.args[0])
+            e = exc.HTTPInternalServerError(detail=detail)
+        return e.response()
 
 #
 # @session
@@ -47,13 +50,14 @@ def session(cookie_key, sessions):
 def cache_control(*directives):
     class cache_control(decorator):
         def __call__(self, req, *a, **k):
-            try:
-                res = self.func(req, *a, **k)
+            def add_header(res):
                 res.update({ "cache-control": ", ".join(directives) })
                 return res
-            except exc.HTTPException as e:
-                e.headers.update({ "cache-control": ", ".join(directives) })
-                raise
+            def add_header_to_error(e):
+                if isinstance(e, exc.HTTPException):
+                    e.headers.update({ "cache-control": ", ".join(directives) })
+                raise e
+            return then(lambda: self.func(req, *a, **k), add_header, add_header_to_error)
     return cache_control
 
 #
@@ -63,32 +67,127 @@ def cache_control(*directives):
 def vary(*headers):
     class vary(decorator):
         def __call__(self, req, *a, **k):
-            try:
-                res = self.func(req, *a, **k)
+            def add_header(res):
                 res.update({ "vary": ", ".join(headers) })
                 return res
-            except exc.HTTPException as e:
-                e.headers.update({ "vary": ", ".join(headers) })
-                raise
+            def add_header_to_error(e):
+                if isinstance(e, exc.HTTPException):
+                    e.headers.update({ "vary": ", ".join(headers) })
+                raise e
+            return then(lambda: self.func(req, *a, **k), add_header, add_header_to_error)
     return vary
 
 #
 # @app_cached
 #
 
-def app_cached(size):
-    def cache_closure(cache, cache_keys): 
-        class app_cached(decorator):
-            def __call__(self, req, *a, **k):
-                hit = a in cache
-                if not hit:
-                    cache[a] = self.func(req, *a, **k)
-                    cache_keys.append(a)
-                    if len(cache_keys) > size:
-                        del cache[cache_keys.pop(0)]
-                response = cache[a].copy()
+def _content_size(response):
+    # None for content whose size can't be told without producing it, like
+    # callables; such responses aren't cached, since max_bytes couldn't
+    # account for them
+    content = response.get("x-content", b"")
+    if isinstance(content, (list, tuple)):
+        return sum(len(chunk) for chunk in content)
+    if hasattr(content, "__len__"):
+        return len(content)
+    return None
+
+def _one_shot(response):
+    content = response.get("x-content")
+    return hasattr(content, "__next__") or hasattr(content, "next")
+
+class _Streamed(object):
+    # one-shot content too big to cache, sent on as it's read: the chunks
+    # read so far, then the rest; it has no length, so it isn't cacheable
+    def __init__(self, chunks, rest):
+        self.chunks = chunks
+        self.rest = rest
+
+    def __iter__(self):
+        return itertools.chain(self.chunks, self.rest)
+
+def _materialize(response, limit=None):
+    # one-shot content (a generator, like the one @accept_encoding makes of
+    # a list) could only be sent once, so it's read into bytes to be cached;
+    # reading stops once it's more than limit bytes
+    if not _one_shot(response):
+        return response
+    content = response["x-content"]
+    chunks = []
+    nbytes = 0
+    for chunk in content:
+        chunks.append(chunk)
+        nbytes += len(chunk)
+        if limit is not None and nbytes > limit:
+            response = response.copy()
+            response["x-content"] = _Streamed(chunks, content)
+            return response
+    response = response.copy()
+    response["x-content"] = chunks[0][:0].join(chunks) if chunks else b""
+    if "content-length" in response:
+        response["content-length"] = len(response["x-content"])
+    return response
+
+def _vary_names(response):
+    # the request headers named by the response's Vary header, or None when
+    # it varies on something other than request headers
+    names = frozenset(name.strip().lower() for name in response.get("vary", "").split(",") if name.strip())
+    return None if "*" in names else names
+
+# headers whose values mean the same regardless of case and spacing; other
+# headers, like Cookie and Authorization, are keyed on their exact value
+CASE_INSENSITIVE = frozenset(["accept", "accept-charset", "accept-encoding", "accept-language"])
+
+def _normalize(name, value):
+    if value is None:
+        return None
+    if name in CASE_INSENSITIVE:
+        return "".join(str(value).lower().split())
+    return str(value)
+
+# namespaces keep handlers that share a cache apart; they are plain numbers
+# so that keys pickle the same way in every worker process
+_namespaces = itertools.count()
+
+def app_cached(size=1024, ttl=None, max_bytes=None, cache=None):
+    cache = cache if cache is not None else LRUCache(size, ttl=ttl, max_bytes=max_bytes)
+    # the most content the cache can take, so bigger content is streamed
+    # instead of read into memory
+    limit = getattr(cache, "max_bytes", getattr(cache, "slot_size", None))
+    namespace = next(_namespaces)
+    # request headers that responses have been seen to vary on; keys include
+    # their normalized values, so every variant is cached separately
+    varying = [()]
+    class app_cached(decorator):
+        def __call__(self, req, *a, **k):
+            names = varying[0]
+            key = (namespace, a, tuple(_normalize(name, req.get(name)) for name in names))
+            def cacheable(response):
+                vary = _vary_names(response)
+                if vary is None or (_content_size(response) is None and not _one_shot(response)):
+                    return False
+                if not vary.issubset(names):
+                    varying[0] = tuple(sorted(vary.union(varying[0])))
+                    return False
+                return True
+            def finish(response, hit):
+                response = response.copy()
                 response.update({ "x-cache": "HIT" if hit else "MISS" })
                 return response
-        return app_cached
-    return cache_closure(dict(), list())
-
+            def prepare(response):
+                return _materialize(response, limit) if (isinstance(response, dict) and cacheable(response)) else response
+            def store(response):
+                if cacheable(response):
+                    response = _materialize(response, limit)
+                    if _content_size(response) is not None:
+                        cache.put(key, response, ttl=ttl, nbytes=_content_size(response))
+                return finish(response, False)
+            # an async handler's awaitable isn't cacheable; its response is
+            # stored once it's done
+            response, hit = cache.fetch(key, lambda: prepare(self.func(req, *a, **k)), ttl=ttl, sizeof=_content_size,
+                                        cacheable=lambda response: isinstance(response, dict) and cacheable(response))
+            if isinstance(response, dict):
+                return finish(response, hit)
+            return then(lambda: response, store)
+    app_cached.cache = cache
+    return app_cached
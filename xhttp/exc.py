@@ -20,6 +20,9 @@ __all__ = [
     'HTTPNotFound',
     'HTTPMethodNotAllowed',
     'HTTPNotAcceptable',
+    'HTTPRequestEntityTooLarge',
+    'HTTPUnsupportedMediaType',
+    'HTTPRequestedRangeNotSatisfiable',
     'HTTPInternalServerError',
     'HTTPNotImplemented'
 ]
@@ -95,6 +98,19 @@ class HTTPNotAcceptable(HTTPException):
     def __init__(self, detail=None):
         super(HTTPNotAcceptable, self).__init__(status.NOT_ACCEPTABLE, { "x-detail": detail })
 
+class HTTPRequestEntityTooLarge(HTTPException):
+    def __init__(self, detail=None):
+        super(HTTPRequestEntityTooLarge, self).__init__(status.REQUEST_ENTITY_TOO_LARGE, { "x-detail": detail })
+
+class HTTPUnsupportedMediaType(HTTPException):
+    def __init__(self, detail=None):
+        super(HTTPUnsupportedMediaType, self).__init__(status.UNSUPPORTED_MEDIA_TYPE, { "x-detail": detail })
+
+class HTTPRequestedRangeNotSatisfiable(HTTPException):
+    def __init__(self, length, detail=None):
+        super(HTTPRequestedRangeNotSatisfiable, self).__init__(status.REQUESTED_RANGE_NOT_SATISFIABLE,
+            { "x-detail": detail, "content-range": "bytes */{0}".format(length) })
+
 class HTTPInternalServerError(HTTPException):
     def __init__(self, detail=None):
         super(HTTPInternalServerError, self).__init__(status.INTERNAL_SERVER_ERROR, 
@@ -1,100 +1,549 @@
-import itertools
+import json
+import numbers
 import re
 import sys
+import tempfile
+import time
+
+# orjson is imported when it's first used, since it takes a while; set it
+# to None to do without
+orjson = NOT_IMPORTED = object()
+
+def _orjson():
+    global orjson
+    if orjson is NOT_IMPORTED:
+        try:
+            import orjson as module
+        except ImportError:
+            module = None
+        orjson = module
+    return orjson
 
 from . import exc
-from .utils import decorator
+from .utils import decorator, CHUNK_SIZE
 
 if sys.version_info[0] == 2:
     from urllib import unquote_plus
 elif sys.version_info[0] == 3:
     from urllib.parse import unquote_plus
 
-__all__ = [ 'get', 'post', 'cookie' ]
+if sys.version_info[0] == 2:
+    bytes, str = str, unicode # pragma: no flakes
+
+__all__ = [ 'FormParser', 'MultipartParser', 'UploadedFile', 'get', 'post', 'cookie', 'multipart', 'compile_schema', 'json_body' ]
 
 #
-# @get / @post / @cookie
+# FormParser
 #
 
-def _parse_x_www_form_urlencoded(parsertype, variables, sep="&"):
-    for (key, pattern) in list(variables.items()):
-        cardinality = "1"
-        if key[-1] in ["?", "+", "*"]:
-            del variables[key]
-            key, cardinality = key[:-1], key[-1]
-        #variables[key] = (cardinality, pattern)
-        variables[key] = (cardinality, re.compile(pattern))
-
-    def parse(s):
-        items = [ item.split("=", 2) for item in s.split(sep) ] if s else []
-        result = { key: list(v[-1] for v in val) for (key, val) in itertools.groupby(items, key=lambda item: item[0]) }
-
-        # make sure all keys exist in result
-        for (key, _) in variables.items():
-            if key not in result:
-                result[key] = []
-
-        # check all keys have an acceptable number of values
-        for (key, (cardinality, _)) in variables.items():
-            if cardinality == "1" and len(result[key]) != 1:
-                raise exc.HTTPBadRequest(detail="{0} parameter {1!r} should occur exactly once".format(parsertype, key))
-            elif cardinality == "?" and len(result[key]) > 1:
-                raise exc.HTTPBadRequest(detail="{0} parameter {1!r} should occur at most once".format(parsertype, key))
-            elif cardinality == "+" and len(result[key]) < 1:
-                raise exc.HTTPBadRequest(detail="{0} parameter {1!r} should occur at least once".format(parsertype, key))
-
-        # check that all keys are known
-        for (key, values) in result.items():
-            if key not in variables:
-                raise exc.HTTPBadRequest(detail="Unknown {0} parameter {1!r}".format(parsertype, key))
-
-        # urldecode values
-        for (key, values) in result.items():
-            if sys.version_info[0] == 3:
-                result[key] = [ unquote_plus(value) for value in values ]
-            elif sys.version_info[0] == 2:
-                result[key] = [ unquote_plus(value).decode("utf8", errors="replace") for value in values ]
-
-        # check that all values comply with regex pattern
-        for (key, (_, pattern)) in variables.items():
-            for value in result[key]:
-                if not pattern.match(value):
-                    raise exc.HTTPBadRequest(detail="{0} parameter {1!r} has bad value {2!r}".format(parsertype, key, value))
-
-        # if cardinality is 1 or ?, store single value instead of list of values
-        for (key, (cardinality, _)) in variables.items():
+clock = getattr(time, "perf_counter", time.time)
+
+def _text(data):
+    if isinstance(data, bytes) and sys.version_info[0] == 3:
+        return data.decode("utf8", errors="replace")
+    return data
+
+def _decode(value):
+    if sys.version_info[0] == 3:
+        return unquote_plus(value) if ("%" in value or "+" in value) else value
+    elif sys.version_info[0] == 2:
+        return unquote_plus(value).decode("utf8", errors="replace")
+
+class FormParser(object):
+    # The variables map names to regexes that their values must match. A
+    # name may end in a cardinality: ? (at most once), + (at least once) or
+    # * (any number of times); without one, it must occur exactly once.
+    # Names with cardinality 1 or ? get a single value (or None), the others
+    # a list of values. Parsing takes a single pass over the pairs and stops
+    # at the first problem; the parser keeps count of how many parses it
+    # did, how many failed and how long they took.
+    MESSAGES = {
+        "1": "{0} parameter {1!r} should occur exactly once",
+        "?": "{0} parameter {1!r} should occur at most once",
+        "+": "{0} parameter {1!r} should occur at least once"
+    }
+
+    def __init__(self, parsertype, variables, sep="&"):
+        self.parsertype = parsertype
+        self.sep = sep
+        self.variables = {}
+        for (key, pattern) in variables.items():
+            cardinality = "1"
+            if key[-1] in ["?", "+", "*"]:
+                key, cardinality = key[:-1], key[-1]
+            self.variables[key] = (cardinality, re.compile(pattern).match)
+        self.parses = 0
+        self.failures = 0
+        self.seconds = 0.0
+
+    def bad_request(self, message, *args):
+        return exc.HTTPBadRequest(detail=message.format(self.parsertype, *args))
+
+    def __call__(self, data, max_fields=None):
+        return self.collect(self.pairs(data), max_fields)
+
+    def pairs(self, data):
+        # the (key, value) pairs in data, a string or an iterable of chunks of
+        # one; there are none in None, like a missing QUERY_STRING
+        if not data:
+            return
+        items = _text(data).split(self.sep) if isinstance(data, (bytes, str)) else self.split(data)
+        for item in items:
+            if item:
+                key, _, value = item.partition("=")
+                yield (key, _decode(value))
+
+    def split(self, chunks):
+        # the items in a string that arrives in chunks, as soon as each is complete
+        rest = None
+        for chunk in chunks:
+            if rest is None:
+                rest, sep = chunk[:0], (self.sep if isinstance(chunk, str) else self.sep.encode("ascii"))
+            items = (rest + chunk).split(sep)
+            rest = items.pop()
+            for item in items:
+                yield _text(item)
+        if rest:
+            yield _text(rest)
+
+    def variable(self, key):
+        try:
+            return self.variables[key]
+        except KeyError:
+            raise self.bad_request("Unknown {0} parameter {1!r}", key)
+
+    def collect(self, pairs, max_fields=None):
+        start = clock()
+        try:
+            return self.parse(pairs, max_fields)
+        except exc.HTTPException:
+            self.failures += 1
+            raise
+        finally:
+            self.parses += 1
+            self.seconds += clock() - start
+
+    def parse(self, pairs, max_fields=None):
+        result = {}
+        fields = 0
+        for (key, value) in pairs:
+            fields += 1
+            if max_fields is not None and fields > max_fields:
+                raise self.bad_request("More than {1} {0} parameters", max_fields)
+            cardinality, match = self.variable(key)
+            # uploaded files are matched by their filename
+            text = getattr(value, "filename", value)
+            if not match(text):
+                raise self.bad_request("{0} parameter {1!r} has bad value {2!r}", key, text)
             if cardinality in ["1", "?"]:
-                result[key] = result[key][0] if result[key] else None
+                if key in result:
+                    raise self.bad_request(self.MESSAGES[cardinality], key)
+                result[key] = value
+            elif key in result:
+                result[key].append(value)
+            else:
+                result[key] = [value]
 
+        for (key, (cardinality, _)) in self.variables.items():
+            if key not in result:
+                if cardinality in ["1", "+"]:
+                    raise self.bad_request(self.MESSAGES[cardinality], key)
+                result[key] = None if cardinality == "?" else []
         return result
 
-    return parse
+    def stats(self):
+        return {
+            "parses": self.parses,
+            "failures": self.failures,
+            "seconds": self.seconds
+        }
+
+#
+# @get / @post / @cookie
+#
 
 def get(variables):
-    parser = _parse_x_www_form_urlencoded("GET", variables, sep="&")
+    parser = FormParser("GET", variables, sep="&")
     class get_dec(decorator):
         def __call__(self, req, *a, **k):
             req["x-get"] = parser(req["x-query-string"])
             return self.func(req, *a, **k)
+    get_dec.parser = parser
     return get_dec
 
-def post(variables):
-    parser = _parse_x_www_form_urlencoded("POST", variables, sep="&")
+def _read_chunked(wsgi_input):
+    # undo chunked transfer coding, for servers that pass it on
+    while True:
+        line = wsgi_input.readline(1024)
+        try:
+            size = int(line.split(b";")[0].strip(), 16)
+        except ValueError:
+            raise exc.HTTPBadRequest(detail="Bad chunk size {0!r}".format(line))
+        if size == 0:
+            while wsgi_input.readline(1024).strip():
+                pass
+            return
+        while size > 0:
+            chunk = wsgi_input.read(min(size, CHUNK_SIZE))
+            if not chunk:
+                raise exc.HTTPBadRequest(detail="Incomplete chunk")
+            size -= len(chunk)
+            yield chunk
+        wsgi_input.readline(1024)
+
+def _read_body(req, max_size):
+    # the request body in chunks, stopping with a 413 as soon as it turns out
+    # to be bigger than max_size
+    wsgi_input = req["x-wsgi-input"]
+    try:
+        remaining = int(req["content-length"])
+    except:
+        remaining = None
+    if remaining is not None:
+        if max_size is not None and remaining > max_size:
+            raise exc.HTTPRequestEntityTooLarge(detail="Body is larger than {0} bytes".format(max_size))
+        chunks = iter(lambda: wsgi_input.read(min(remaining, CHUNK_SIZE)) if remaining > 0 else b"", b"")
+    elif "chunked" in req.get("transfer-encoding", "").lower():
+        if req.get("x-wsgi-input-terminated", False):
+            chunks = iter(lambda: wsgi_input.read(CHUNK_SIZE), b"")
+        else:
+            chunks = _read_chunked(wsgi_input)
+    else:
+        return
+
+    size = 0
+    for chunk in chunks:
+        if not chunk:
+            break
+        size += len(chunk)
+        if max_size is not None and size > max_size:
+            raise exc.HTTPRequestEntityTooLarge(detail="Body is larger than {0} bytes".format(max_size))
+        if remaining is not None:
+            remaining -= len(chunk)
+        yield chunk
+
+def post(variables, max_size=1024 * 1024, max_fields=1000):
+    parser = FormParser("POST", variables, sep="&")
     class post_dec(decorator):
         def __call__(self, req, *a, **k):
-            try:
-                content_length = int(req["content-length"])
-            except:
-                content_length = 0
-            wsgi_input = req["x-wsgi-input"].read(content_length)
-            req["x-post"] = parser(wsgi_input)
+            req["x-post"] = parser(_read_body(req, max_size), max_fields)
             return self.func(req, *a, **k)
+    post_dec.parser = parser
     return post_dec
     
 def cookie(variables):
-    parser = _parse_x_www_form_urlencoded("Cookie", variables, sep="; ")
+    parser = FormParser("Cookie", variables, sep="; ")
     class cookie_dec(decorator):
         def __call__(self, req, *a, **k):
             req["x-cookie"] = parser(req.get("cookie", ""))
             return self.func(req, *a, **k)
+    cookie_dec.parser = parser
     return cookie_dec
+
+#
+# MultipartParser
+#
+
+def _multipart_events(chunks, boundary, max_header_size=16384):
+    # The parts of a multipart body as they're read: for each part a
+    # ("headers", bytes) event, ("data", bytes) events for its content, and
+    # an ("end", None) event. Only the last few bytes, which could be the
+    # start of a delimiter, are held back between chunks.
+    delimiter = b"\r\n--" + boundary
+    keep = len(delimiter) - 1
+    buf = b"\r\n" # so a delimiter at the very start is found like the others
+    state = "preamble"
+    chunks = iter(chunks)
+    while True:
+        if state == "preamble":
+            i = buf.find(delimiter)
+            if i >= 0:
+                buf, state = buf[i+len(delimiter):], "delimiter"
+                continue
+            buf = buf[-keep:]
+        elif state == "delimiter":
+            if buf[:2] == b"--":
+                return
+            i = buf.find(b"\r\n")
+            if i >= 0:
+                if buf[:i].strip(b" \t"):
+                    raise exc.HTTPBadRequest(detail="Bad multipart delimiter")
+                buf, state = buf[i+2:], "headers"
+                continue
+            if len(buf) > 1024:
+                raise exc.HTTPBadRequest(detail="Bad multipart delimiter")
+        elif state == "headers":
+            i = -2 if buf[:2] == b"\r\n" else buf.find(b"\r\n\r\n")
+            if i != -1:
+                yield ("headers", buf[:max(i, 0)])
+                buf, state = buf[i+4:], "body"
+                continue
+            if len(buf) > max_header_size:
+                raise exc.HTTPBadRequest(detail="Multipart headers too large")
+        elif state == "body":
+            i = buf.find(delimiter)
+            if i >= 0:
+                if i:
+                    yield ("data", buf[:i])
+                yield ("end", None)
+                buf, state = buf[i+len(delimiter):], "delimiter"
+                continue
+            if len(buf) > keep:
+                yield ("data", buf[:-keep])
+                buf = buf[-keep:]
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise exc.HTTPBadRequest(detail="Incomplete multipart body")
+        buf += chunk
+
+_PARAMETER = re.compile(r';\s*([^\s;=]+)\s*=\s*("[^"]*"|[^;]*)')
+
+def _part_headers(data):
+    # (name, filename, content type) of a part; filename is None for fields
+    name, filename, content_type = None, None, "text/plain"
+    for line in data.decode("utf8", "replace").split("\r\n"):
+        key, _, value = line.partition(":")
+        key = key.strip().lower()
+        if key == "content-disposition":
+            parameters = { k.lower(): v.strip().strip('"') for (k, v) in _PARAMETER.findall(value) }
+            name, filename = parameters.get("name"), parameters.get("filename")
+        elif key == "content-type":
+            content_type = value.strip()
+    if filename is not None:
+        # some browsers send the whole path
+        filename = re.split(r"[/\\]", filename)[-1]
+    return (name, filename, content_type)
+
+class UploadedFile(object):
+    # A file part of a multipart/form-data body, with its content in file,
+    # positioned at the start. Files bigger than the parser's spool_size are
+    # kept in a temporary file, which is removed when it's closed.
+    def __init__(self, filename, content_type, file, size):
+        self.filename = filename
+        self.content_type = content_type
+        self.file = file
+        self.size = size
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def close(self):
+        self.file.close()
+
+    def __repr__(self):
+        return "UploadedFile({0!r}, {1!r}, size={2})".format(self.filename, self.content_type, self.size)
+
+class MultipartParser(FormParser):
+    # Parses multipart/form-data as it's read, checking it against variables
+    # like FormParser does; files are checked by their filename. Fields are
+    # kept in memory, up to field_size bytes each. Files are UploadedFiles
+    # that spill to a temporary file in spool_dir past spool_size bytes.
+    def __init__(self, variables, field_size=64 * 1024, spool_size=1024 * 1024, spool_dir=None):
+        FormParser.__init__(self, "POST", variables)
+        self.field_size = field_size
+        self.spool_size = spool_size
+        self.spool_dir = spool_dir
+
+    def __call__(self, chunks, boundary, max_fields=None):
+        files = []
+        try:
+            return self.collect(self.pairs(chunks, boundary, files), max_fields)
+        except Exception:
+            for f in files:
+                f.close()
+            raise
+
+    def pairs(self, chunks, boundary, files):
+        for (event, data) in _multipart_events(chunks, boundary):
+            if event == "headers":
+                name, filename, content_type = _part_headers(data)
+                if name is None:
+                    raise self.bad_request("{0} part without a name")
+                # unknown names are refused before their content is read
+                self.variable(name)
+                if filename is None:
+                    parts, size = [], 0
+                else:
+                    spool = tempfile.SpooledTemporaryFile(max_size=self.spool_size, dir=self.spool_dir)
+                    files.append(spool)
+                    size = 0
+            elif event == "data":
+                size += len(data)
+                if filename is None:
+                    if size > self.field_size:
+                        raise exc.HTTPRequestEntityTooLarge(detail="POST parameter {0!r} is larger than {1} bytes".format(name, self.field_size))
+                    parts.append(data)
+                else:
+                    spool.write(data)
+            elif filename is None:
+                yield (name, b"".join(parts).decode("utf8", "replace"))
+            elif filename or size:
+                # browsers send an empty part with an empty filename for an empty file input
+                spool.seek(0)
+                yield (name, UploadedFile(filename, content_type, spool, size))
+
+#
+# @multipart
+#
+
+_BOUNDARY = re.compile(r';\s*boundary\s*=\s*(?:"([^"]+)"|([^\s;]+))', re.I)
+
+def multipart(variables, max_size=None, max_fields=1000, field_size=64 * 1024, spool_size=1024 * 1024, spool_dir=None):
+    parser = MultipartParser(variables, field_size, spool_size, spool_dir)
+    class multipart_dec(decorator):
+        def __call__(self, req, *a, **k):
+            content_type = req.get("content-type") or ""
+            match = _BOUNDARY.search(content_type)
+            if not content_type.lower().startswith("multipart/form-data") or not match:
+                raise exc.HTTPUnsupportedMediaType(detail="Expected multipart/form-data, got {0!r}".format(content_type))
+            boundary = (match.group(1) or match.group(2)).encode("latin-1")
+            req["x-post"] = parser(_read_body(req, max_size), boundary, max_fields)
+            return self.func(req, *a, **k)
+    multipart_dec.parser = parser
+    return multipart_dec
+
+#
+# compile_schema
+#
+
+_SCHEMA_TYPES = {
+    "object" : lambda value: isinstance(value, dict),
+    "array"  : lambda value: isinstance(value, list),
+    "string" : lambda value: isinstance(value, str),
+    "number" : lambda value: isinstance(value, numbers.Real) and not isinstance(value, bool),
+    "integer": lambda value: isinstance(value, numbers.Integral) and not isinstance(value, bool),
+    "boolean": lambda value: isinstance(value, bool),
+    "null"   : lambda value: value is None
+}
+
+_SCHEMA_KEYWORDS = set("""
+    type enum properties required additionalProperties items minItems maxItems
+    minLength maxLength pattern minimum maximum
+""".split())
+
+def _invalid(path, message, *args):
+    return exc.HTTPBadRequest(detail="JSON body {0} {1}".format(path, message.format(*args)))
+
+def compile_schema(schema):
+    # Turns a JSON schema, of which the keywords in _SCHEMA_KEYWORDS are
+    # supported, into a function check(value, path) that raises a 400 for
+    # values that don't match. All the work of reading the schema is done
+    # here, once; check() only runs the checks that apply.
+    unknown = set(schema) - _SCHEMA_KEYWORDS
+    if unknown:
+        raise ValueError("Unsupported schema keywords: {0}".format(", ".join(sorted(unknown))))
+    checks = []
+
+    if "type" in schema:
+        names = [schema["type"]] if isinstance(schema["type"], (bytes, str)) else list(schema["type"])
+        if not set(names) <= set(_SCHEMA_TYPES):
+            raise ValueError("Unsupported schema type: {0}".format(schema["type"]))
+        tests = [ _SCHEMA_TYPES[name] for name in names ]
+        expected = " or ".join(names)
+        def check_type(value, path):
+            if not any(test(value) for test in tests):
+                raise _invalid(path, "should be {0}", expected)
+        checks.append(check_type)
+
+    if "enum" in schema:
+        enum = list(schema["enum"])
+        def check_enum(value, path):
+            if not any(value == option and isinstance(value, bool) == isinstance(option, bool) for option in enum):
+                raise _invalid(path, "should be one of {0}", json.dumps(enum))
+        checks.append(check_enum)
+
+    if "minimum" in schema or "maximum" in schema:
+        minimum, maximum = schema.get("minimum"), schema.get("maximum")
+        def check_range(value, path):
+            if _SCHEMA_TYPES["number"](value):
+                if minimum is not None and value < minimum:
+                    raise _invalid(path, "should be at least {0}", minimum)
+                if maximum is not None and value > maximum:
+                    raise _invalid(path, "should be at most {0}", maximum)
+        checks.append(check_range)
+
+    if "minLength" in schema or "maxLength" in schema or "pattern" in schema:
+        min_length, max_length = schema.get("minLength", 0), schema.get("maxLength")
+        match = re.compile(schema["pattern"]).search if "pattern" in schema else None
+        def check_string(value, path):
+            if isinstance(value, str):
+                if len(value) < min_length or (max_length is not None and len(value) > max_length):
+                    raise _invalid(path, "has a bad length")
+                if match and not match(value):
+                    raise _invalid(path, "should match {0!r}", schema["pattern"])
+        checks.append(check_string)
+
+    if "properties" in schema or "required" in schema or "additionalProperties" in schema:
+        properties = { key: compile_schema(value) for (key, value) in schema.get("properties", {}).items() }
+        required = list(schema.get("required", []))
+        additional = schema.get("additionalProperties", True)
+        additional = compile_schema(additional) if isinstance(additional, dict) else additional
+        def check_object(value, path):
+            if isinstance(value, dict):
+                for key in required:
+                    if key not in value:
+                        raise _invalid(path, "should have property {0!r}", key)
+                for (key, item) in value.items():
+                    check = properties.get(key, additional)
+                    if check is False:
+                        raise _invalid(path, "has unknown property {0!r}", key)
+                    elif check is not True:
+                        check(item, "{0}.{1}".format(path, key))
+        checks.append(check_object)
+
+    if "items" in schema or "minItems" in schema or "maxItems" in schema:
+        items = compile_schema(schema["items"]) if "items" in schema else None
+        min_items, max_items = schema.get("minItems", 0), schema.get("maxItems")
+        def check_array(value, path):
+            if isinstance(value, list):
+                if len(value) < min_items or (max_items is not None and len(value) > max_items):
+                    raise _invalid(path, "has a bad number of items")
+                if items:
+                    for (i, item) in enumerate(value):
+                        items(item, "{0}[{1}]".format(path, i))
+        checks.append(check_array)
+
+    if len(checks) == 1:
+        return checks[0]
+    def check(value, path):
+        for c in checks:
+            c(value, path)
+    return check
+
+#
+# @json_body
+#
+
+# a run of digits that may be an integer beyond 64 bits, which orjson turns
+# into a float or refuses
+_LONG_NUMBER = re.compile(br"\d{19}")
+
+def _json_loads(data):
+    # orjson is several times faster, when it's installed; json does what it
+    # can't, and reports errors, so the result is the same either way
+    if isinstance(data, bytes) and _orjson() is not None and not _LONG_NUMBER.search(data):
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            pass
+    return json.loads(data.decode("utf8") if isinstance(data, bytes) else data)
+
+def json_body(schema=None, max_size=1024 * 1024):
+    check = compile_schema(schema) if schema is not None else None
+    class json_body_dec(decorator):
+        def __call__(self, req, *a, **k):
+            content_type = req.get("content-type") or ""
+            media_type = content_type.split(";")[0].strip().lower()
+            if media_type != "application/json" and not media_type.endswith("+json"):
+                raise exc.HTTPUnsupportedMediaType(detail="Expected application/json, got {0!r}".format(content_type))
+            data = b"".join(_read_body(req, max_size))
+            try:
+                value = _json_loads(data)
+            except ValueError as e:
+                raise exc.HTTPBadRequest(detail="Bad JSON body: {0}".format(e))
+            if check is not None:
+                check(value, "$")
+            req["x-json"] = value
+            return self.func(req, *a, **k)
+    json_body_dec.check = check
+    return json_body_dec
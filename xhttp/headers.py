@@ -1,48 +1,112 @@
 from __future__ import division, absolute_import, print_function
 
+import calendar
 import datetime
 import re
 import sys
+import time
 
-import dateutil
-import dateutil.parser
+from .cache import LockedLRUCache, MISSING
 
-from . import exc
 
 if sys.version_info[0] == 2:
     bytes, str = str, unicode # pragma: no flakes
 
-__all__ = [ 'QListHeader', 'DateHeader', 'RangeHeader' ]
+if sys.version_info[0] == 2:
+    import dateutil.tz
+    UTC = dateutil.tz.tzutc()
+elif sys.version_info[0] == 3:
+    UTC = datetime.timezone.utc
+
+__all__ = [ 'HeaderValue', 'QListHeader', 'DateHeader', 'RangeHeader' ]
+
+#
+# HeaderValue
+#
+
+class HeaderValue(object):
+    # Parsed header values are immutable, so that they can be shared between
+    # requests and cached. Subclasses declare their __slots__ and fill them
+    # in through init().
+    __slots__ = []
+
+    def init(self, **attrs):
+        for (name, value) in attrs.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{0} is immutable".format(type(self).__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError("{0} is immutable".format(type(self).__name__))
+
+    def __repr__(self):
+        return "{0}({1})".format(type(self).__name__, repr(str(self)))
 
 #
 # QListHeader
 # 
 
-class QListHeader(object):
+class QListHeader(HeaderValue):
+    # Browsers send the same few header strings over and over, so each
+    # distinct string is parsed once into a shared QListHeader, which also
+    # remembers the outcome of negotiating the MEMO_SIZE most recently used
+    # sets of keys against it. items holds (q, index, value) in order of preference and
+    # lowered the same values in lowercase.
+    __slots__ = ["items", "lowered", "text", "memo"]
+
     _comma = re.compile(r"\s*,\s*")
     _semicolon = re.compile(r"\s*;\s*")
 
-    def __init__(self, s):
+    cache = LockedLRUCache(1024)
+    MEMO_SIZE = 64
+
+    def __new__(cls, s):
+        try:
+            return cls.cache.fetch((cls, s), lambda: cls.parse(s))[0]
+        except TypeError:
+            return cls.parse(s)
+
+    def __reduce__(self):
+        return (type(self), (self.text,))
+
+    @classmethod
+    def parse(cls, s):
+        self = super(QListHeader, cls).__new__(cls)
         try: 
-            items = self._comma.split(s)
+            items = [ item for item in self._comma.split(s) if item ]
             items = [ self._semicolon.split(item) for item in items ]
             items = [ t if len(t) == 2 else (t + ["q=1.0"]) for t in items ]
             items = [ (m, q.split('=')[1]) for (m, q) in items ] 
             items = [ (float(q), i, m) for (i, (m, q)) in enumerate(items) ]
-            self.items = sorted(items, key=lambda qiv: (1-qiv[0], qiv[1], qiv[2]))
         except:
-            self.items = []
+            items = []
+        text = ",".join((v + (";q={0}".format(q) if q != 1.0 else "")) for (q, i, v) in items)
+        items = tuple(sorted(items, key=lambda qiv: (1-qiv[0], qiv[1], qiv[2])))
+        self.init(items=items, lowered=tuple(v.lower() for (_, _, v) in items), text=text, memo=LockedLRUCache(cls.MEMO_SIZE))
+        return self
 
-    def __str__(self):
-        return ",".join((v + (";q={0}".format(q) if q != 1.0 else ""))
-                        for (q, i, v) in sorted(self.items, key=lambda qiv: qiv[1]))
+    def memoized(self, name, keys, negotiate):
+        keys = tuple(keys)
+        try:
+            result = self.memo.get((name, keys), MISSING)
+        except TypeError:
+            return negotiate(keys)
+        if result is MISSING:
+            result = negotiate(keys)
+            self.memo.put((name, keys), result)
+        return result
 
-    def __repr__(self):
-        return "{0}({1})".format(type(self).__name__, repr(str(self)))
+    def __str__(self):
+        return self.text
 
     def negotiate(self, keys):
-        for (_, _, v) in self.items:
-            if any(v.lower() == k.lower() for k in keys):
+        return self.memoized("negotiate", keys, self._negotiate)
+
+    def _negotiate(self, keys):
+        lowered = { k.lower() for k in keys }
+        for ((_, _, v), lv) in zip(self.items, self.lowered):
+            if lv in lowered:
                 return v
         return None
 
@@ -51,18 +115,21 @@ class QListHeader(object):
         # TODO: implement this
 
     def negotiate_mime(self, keys):
-        for (_, _, v) in self.items:
+        return self.memoized("negotiate_mime", keys, self._negotiate_mime)
+
+    def _negotiate_mime(self, keys):
+        lowered = [ k.lower() for k in keys ]
+        for lv in self.lowered:
             # match anything
-            if (v == "*/*") and keys:
+            if (lv == "*/*") and keys:
                 return keys[0]
             # match exactly
-            for k in keys:
-                if k.lower() == v.lower():
+            for (k, lk) in zip(keys, lowered):
+                if lk == lv:
                     return k
             # match partially
-            for k in keys:
-                s = k.split("/")[0] + "/*"
-                if s.lower() == v.lower():
+            for (k, lk) in zip(keys, lowered):
+                if lk.split("/")[0] + "/*" == lv:
                     return k
         return None
 
@@ -70,37 +137,58 @@ class QListHeader(object):
 # DateHeader
 #
 
-class DateHeader(object):
+class DateHeader(HeaderValue):
+    # The three date formats of RFC 7231 are parsed with regexes, anything
+    # else goes through dateutil. Formatted dates are cached by timestamp.
+    __slots__ = ["tz", "timestamp", "text"]
+
     WEEKDAYS = 'Mon Tue Wed Thu Fri Sat Sun'.split()
     MONTHS = 'Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec'.split()
-    TZ_UTC = dateutil.tz.tzutc()
+    TZ_UTC = UTC
+
+    # IMF-fixdate (also accepting numeric zones), RFC 850 and asctime
+    _imf_fixdate = re.compile(r"^\s*(?:[A-Za-z]{3}, )?(\d{1,2}) ([A-Za-z]{3}) (\d{4}) (\d\d):(\d\d):(\d\d) (GMT|UTC|[+-]\d{4})\s*$")
+    _rfc850 = re.compile(r"^\s*[A-Za-z]+, (\d\d)-([A-Za-z]{3})-(\d\d) (\d\d):(\d\d):(\d\d) GMT\s*$")
+    _asctime = re.compile(r"^\s*[A-Za-z]{3} ([A-Za-z]{3}) {1,2}(\d{1,2}) (\d\d):(\d\d):(\d\d) (\d{4})\s*$")
+    _month_numbers = { m.lower(): i + 1 for (i, m) in enumerate(MONTHS) }
+
+    formatted = LockedLRUCache(1024)
 
     def __init__(self, x, tz=TZ_UTC):
-        self.tz = tz 
         if isinstance(x, bytes):
             x = x.decode('us-ascii')
         if isinstance(x, str):
-            self.timestamp = self.parse(x)
+            timestamp = self.parse(x)
         elif isinstance(x, int):
-            self.timestamp = x
+            timestamp = x
         elif isinstance(x, float):
-            self.timestamp = int(x)
+            timestamp = int(x)
         else:
             raise ValueError("Unsupported type {0}".format(type(x).__name__))
+        self.init(tz=tz, timestamp=timestamp, text=None)
+
+    def __reduce__(self):
+        return (type(self), (self.timestamp, self.tz))
 
     def __str__(self):
-        dt = datetime.datetime.utcfromtimestamp(self.timestamp)
+        if self.text is None:
+            self.init(text=self.formatted.fetch(self.timestamp, lambda: self.format(self.timestamp))[0])
+        return self.text
+
+    @classmethod
+    def format(cls, timestamp):
+        t = time.gmtime(timestamp)
         return "{0}, {1:02} {2} {3} {4:02}:{5:02}:{6:02} GMT".format(
-            DateHeader.WEEKDAYS[dt.weekday()], 
-            dt.day,
-            DateHeader.MONTHS[dt.month-1],
-            dt.year,
-            dt.hour,
-            dt.minute,
-            dt.second)
+            cls.WEEKDAYS[t.tm_wday], 
+            t.tm_mday,
+            cls.MONTHS[t.tm_mon-1],
+            t.tm_year,
+            t.tm_hour,
+            t.tm_min,
+            t.tm_sec)
 
-    def __repr__(self):
-        return "{0}({1})".format(type(self).__name__, repr(str(self)))
+    def __hash__(self):
+        return hash(self.timestamp)
 
     def __eq__(self, other):
         return not self < other and not other < self
@@ -121,28 +209,70 @@ class DateHeader(object):
         return self.timestamp < other.timestamp
 
     def parse(self, s):
+        timestamp = self.parse_http_date(s)
+        if timestamp is not None:
+            return timestamp
+        import dateutil.parser
         dt = dateutil.parser.parse(s).astimezone(DateHeader.TZ_UTC)
         ts = dt - datetime.datetime(1970, 1, 1, 0, 0, 0, tzinfo=DateHeader.TZ_UTC)
         return int(ts.total_seconds())
 
+    def parse_http_date(self, s):
+        offset = 0
+        match = self._imf_fixdate.match(s)
+        if match:
+            day, month, year, hour, minute, second, zone = match.groups()
+            if zone[0] in "+-":
+                offset = (int(zone[1:3]) * 60 + int(zone[3:5])) * (60 if zone[0] == "+" else -60)
+        else:
+            match = self._rfc850.match(s)
+            if match:
+                day, month, year, hour, minute, second = match.groups()
+                year = int(year) + (1900 if int(year) >= 70 else 2000)
+            else:
+                match = self._asctime.match(s)
+                if not match:
+                    return None
+                month, day, hour, minute, second, year = match.groups()
+        month = self._month_numbers.get(month.lower())
+        year, day, hour, minute, second = int(year), int(day), int(hour), int(minute), int(second)
+        if not month or not (hour < 24 and minute < 60 and second < 61):
+            return None
+        # timegm() would carry a day past the end of the month into the next
+        if not 1 <= day <= calendar.monthrange(year, month)[1]:
+            return None
+        return calendar.timegm((year, month, day, hour, minute, second)) - offset
+
 #
 # RangeHeader 
 #
 
-class RangeHeader(object):
-    __slots__ = ["unit", "start", "stop"]
+class RangeHeader(HeaderValue):
+    __slots__ = ["unit", "ranges", "start", "stop", "text"]
 
     def __init__(self, s):
-        self.unit, self.start, self.stop = self.parse(s)
+        unit, ranges = self.parse(s)
+        text = "{0}={1}".format(unit, ",".join("{0}-{1}".format("" if start is None else start, "" if stop is None else stop)
+                                               for (start, stop) in ranges))
+        self.init(unit=unit, ranges=tuple(ranges), start=ranges[0][0], stop=ranges[0][1], text=text)
+
+    def __reduce__(self):
+        return (type(self), (self.text,))
+
+    def __str__(self):
+        return self.text
 
     def __repr__(self):
-        return "{0}({1!r}, {2!r}, {3!r})".format(type(self).__name__, self.unit, self.start, self.stop)
+        if len(self.ranges) == 1:
+            return "{0}({1!r}, {2!r}, {3!r})".format(type(self).__name__, self.unit, self.start, self.stop)
+        return "{0}({1!r}, {2!r})".format(type(self).__name__, self.unit, self.ranges)
 
     def parse(self, s):
         unit, ranges = s.split("=", 1)
-        if len(ranges.split(",")) > 1:
-            raise exc.HTTPNotImplemented(detail="Multiple ranges are not implemented")
-        start, stop = ranges.split("-", 1)
+        return unit, [ self.parse_range(r) for r in ranges.split(",") if r.strip() ] or [(None, None)]
+
+    def parse_range(self, r):
+        start, stop = r.strip().split("-", 1)
         try:
             start = int(start)
         except:
@@ -151,4 +281,4 @@ class RangeHeader(object):
             stop = int(stop)
         except:
             stop = None
-        return unit, start, stop
+        return start, stop
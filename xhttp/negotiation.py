@@ -1,25 +1,104 @@
+import collections
 import json
 import sys
 
 import xmlist
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# orjson is imported when it's first used, since it takes a while; set it
+# to None to do without
+orjson = NOT_IMPORTED = object()
+
+def _orjson():
+    global orjson
+    if orjson is NOT_IMPORTED:
+        try:
+            import orjson as module
+        except ImportError:
+            module = None
+        orjson = module
+    return orjson
+
 from . import exc
 from .headers import QListHeader
-from .utils import decorator, gzip_encode
+from .utils import decorator, then, compress_iter, CHUNK_SIZE
+from .utils import gzip_encode, gzip_encode_iter, deflate_encode, deflate_encode_iter
 
 if sys.version_info[0] == 2:
     bytes, str = str, unicode # pragma: no flakes
 
-__all__ = [ 'custom_accept', 'accept', 'accept_encoding', 'accept_charset' ]
+__all__ = [ 'json_serializer', 'custom_accept', 'accept', 'register_codec', 'accept_encoding', 'accept_charset' ]
+
+#
+# json_serializer
+#
+
+def _json_dumps(content):
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":"))
+
+def _orjson_dumps(content):
+    # orjson can't do everything json can (e.g. integers over 64 bits)
+    try:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    except TypeError:
+        return _json_dumps(content)
+
+def _iterencode(content, chunk_size):
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+    parts, size = [], 0
+    for part in encoder.iterencode(content):
+        parts.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield "".join(parts).encode("utf8")
+            parts, size = [], 0
+    if parts:
+        yield "".join(parts).encode("utf8")
+
+def json_serializer(mode="pretty", dumps=None, chunk_size=CHUNK_SIZE):
+    # Serializers for custom_accept. "pretty" sorts keys and indents, which
+    # is what @accept does. "compact" leaves out whitespace and doesn't sort,
+    # using dumps if given, orjson if it's installed, or else json's C
+    # encoder. "stream" is compact too, but produces the document in chunks
+    # of about chunk_size characters as it's encoded, rather than all at
+    # once. Both produce UTF-8 bytes whichever encoder is used, and have a
+    # charset attribute that custom_accept adds to the content type.
+    if mode == "pretty":
+        return lambda content: json.dumps(obj=content, sort_keys=1, ensure_ascii=False, indent=4)
+    elif mode == "compact":
+        if dumps is None:
+            dumps = _orjson_dumps if _orjson() is not None else _json_dumps
+        def serialize(content):
+            data = dumps(content)
+            return data.encode("utf8") if isinstance(data, str) else data
+    elif mode == "stream":
+        serialize = lambda content: _iterencode(content, chunk_size)
+    else:
+        raise ValueError("Unknown JSON serializer mode {0!r}".format(mode))
+    serialize.charset = "UTF-8"
+    return serialize
 
 #
 # @accept
 #
 
 def custom_accept(serializers):
+    # copied, so changes to the dict don't affect the decorator
+    serializers = dict(serializers)
     class accept(decorator):
         def __call__(self, req, *a, **k):
-            res = self.func(req, *a, **k)
+            return then(lambda: self.func(req, *a, **k), lambda res: self.serialize(req, res))
+
+        def serialize(self, req, res):
             accept = req["accept"] if "accept" in req else QListHeader("*/*")
             content_view = res.pop("x-content-view")
             content_type = accept.negotiate_mime(content_view.keys())
@@ -30,34 +109,147 @@ def custom_accept(serializers):
                 if content_type in serializers:
                     serialize_obj = serializers[content_type]
                     res["x-content"] = serialize_obj(res["x-content"])
+                    if getattr(serialize_obj, "charset", None):
+                        res["content-type"] += "; charset={0}".format(serialize_obj.charset)
                 return res
             else:
                 raise exc.HTTPNotAcceptable()
     return accept
 
-accept = custom_accept({
+SERIALIZERS = {
     "application/xml"       : lambda content: xmlist.serialize_xml(content),
     "application/xhtml+xml" : lambda content: xmlist.serialize_xml(content),
     "text/html"             : lambda content: xmlist.serialize_html(content),
-    "application/json"      : lambda content: json.dumps(obj=content, sort_keys=1, ensure_ascii=False, indent=4),
-})
+    "application/json"      : json_serializer("pretty"),
+}
+
+accept = custom_accept(SERIALIZERS)
+
+#
+# content codings
+#
+
+# coding -> (encode(bytes, level), encode_iter(chunks, level), default level),
+# in order of preference when a client accepts any coding with "*"
+CODECS = collections.OrderedDict()
+
+def register_codec(name, encode, encode_iter, level):
+    CODECS[name.lower()] = (encode, encode_iter, level)
+
+def _brotli_encode_iter(chunks, level):
+    compressor = brotli.Compressor(quality=level)
+    return compress_iter(chunks, compressor.process, compressor.finish)
+
+def _zstd_encode_iter(chunks, level):
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    return compress_iter(chunks, compressor.compress, compressor.flush)
+
+if zstandard is not None:
+    register_codec("zstd", lambda s, level: zstandard.ZstdCompressor(level=level).compress(s), _zstd_encode_iter, 3)
+
+if brotli is not None:
+    register_codec("br", lambda s, level: brotli.compress(s, quality=level), _brotli_encode_iter, 4)
+
+register_codec("gzip", gzip_encode, gzip_encode_iter, 6)
+register_codec("deflate", deflate_encode, deflate_encode_iter, 6)
+
+def _media_type(content_type):
+    return content_type.split(";")[0].strip().lower()
 
 #
 # @accept_encoding
 #
 
 class accept_encoding(decorator):
+    # content smaller than MIN_SIZE bytes, or whose type isn't in TYPES (or
+    # ending in one of SUFFIXES), isn't worth compressing
+    MIN_SIZE = 256
+    TYPES = ["text/*", "application/json", "application/javascript", "application/xml", "image/svg+xml"]
+    SUFFIXES = ["+xml", "+json"]
+
+    # the registered codings to offer (None for all of them), and compression
+    # levels by media type, e.g. { "application/json": { "zstd": 1 } }
+    CODINGS = None
+    LEVELS = {}
+
+    @classmethod
+    def compressible(cls, content_type, length):
+        if length is not None and length < cls.MIN_SIZE:
+            return False
+        if not content_type:
+            return True
+        media_type = _media_type(content_type)
+        return (media_type in cls.TYPES
+                or (media_type.split("/")[0] + "/*") in cls.TYPES
+                or any(media_type.endswith(suffix) for suffix in cls.SUFFIXES))
+
+    @classmethod
+    def choose(cls, accept, offered=None):
+        # the offered coding the client gives the highest q-value, or the
+        # first one it lists among equals; "*" stands for any coding it
+        # doesn't mention, and q=0 means not acceptable. By default the
+        # registered codings are offered.
+        if offered is None:
+            offered = [ coding for coding in (cls.CODINGS or CODECS) if coding in CODECS ]
+        mentioned = set(accept.lowered)
+        for ((q, _, _), coding) in zip(accept.items, accept.lowered):
+            if q <= 0:
+                break
+            if coding == "identity":
+                return None
+            if coding == "*":
+                coding = next((c for c in offered if c not in mentioned), None)
+            if coding in offered:
+                return coding
+        return None
+
+    @classmethod
+    def level(cls, coding, content_type):
+        if content_type:
+            media_type = _media_type(content_type)
+            for key in (media_type, media_type.split("/")[0] + "/*"):
+                if coding in cls.LEVELS.get(key, {}):
+                    return cls.LEVELS[key][coding]
+        return CODECS[coding][2]
+
     def __call__(self, req, *a, **k):
-        res = self.func(req, *a, **k)
+        return then(lambda: self.func(req, *a, **k), lambda res: self.encode(req, res))
+
+    def encode(self, req, res):
         if "accept-encoding" not in req:
             return res
-        if req["accept-encoding"].negotiate(["gzip"]):
-            content = gzip_encode(res["x-content"])
-            res.update({
-                "x-content": content,
-                "content-encoding": "gzip",
-                "content-length": len(content)
-            })
+        if "x-content" not in res or "content-encoding" in res:
+            return res
+        coding = self.choose(req["accept-encoding"])
+        if coding:
+            content = res["x-content"]
+            if callable(content):
+                # called once; what it made is passed on even if it isn't
+                # compressed
+                content = res["x-content"] = content()
+            if isinstance(content, str):
+                return res
+            if hasattr(content, "__len__") and not isinstance(content, (list, tuple)):
+                length = len(content)
+            else:
+                length = res.get("content-length", None)
+            if not self.compressible(res.get("content-type"), None if length is None else int(length)):
+                return res
+            encode, encode_iter, _ = CODECS[coding]
+            level = self.level(coding, res.get("content-type"))
+            if isinstance(content, bytes):
+                content = encode(content, level)
+                res.update({
+                    "x-content": content,
+                    "content-encoding": coding,
+                    "content-length": len(content)
+                })
+            else:
+                res.pop("content-length", None)
+                res.update({
+                    "x-content": encode_iter(content, level),
+                    "content-encoding": coding
+                })
         return res
 
 #
@@ -66,7 +258,9 @@ class accept_encoding(decorator):
 
 class accept_charset(decorator):
     def __call__(self, req, *a, **k):
-        res = self.func(req, *a, **k)
+        return then(lambda: self.func(req, *a, **k), lambda res: self.encode(req, res))
+
+    def encode(self, req, res):
         if "x-content" not in res:
             return res
         if isinstance(res["x-content"], str):
@@ -0,0 +1,442 @@
+from __future__ import print_function
+
+import errno
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+import wsgiref.simple_server
+
+from . import exc
+
+if sys.version_info[0] == 2:
+    import Queue as queue
+elif sys.version_info[0] == 3:
+    import queue
+
+__all__ = [ 'fix_wsgiref', 'RequestBody', 'ChunkedBody', 'KeepAliveRequestHandler', 'WSGIServer', 'make_server', 'run_server' ]
+
+# environment variable through which a reloaded server finds its socket
+LISTEN_FD = "XHTTP_LISTEN_FD"
+
+#
+# fix_wsgiref
+#
+
+def fix_wsgiref(app, document_root=None):
+    document_root = document_root or os.getcwd()
+    def fixed_app(environ, start_response):
+        # add REQUEST_URI
+        if 'REQUEST_URI' not in environ:
+            environ['REQUEST_URI'] = environ['PATH_INFO']
+            if environ['QUERY_STRING']:
+                environ['REQUEST_URI'] += '?'
+                environ['REQUEST_URI'] += environ['QUERY_STRING']
+        # add DOCUMENT_ROOT
+        environ['DOCUMENT_ROOT'] = document_root
+        # do it
+        return app(environ, start_response)
+    return fixed_app
+
+#
+# RequestBody
+#
+
+class RequestBody(object):
+    # wsgi.input for a request on a connection that's kept alive: reading
+    # stops at the end of the body, and drain() skips what the app didn't
+    # read, so the next request starts where it should
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def limit(self, size):
+        return self.remaining if (size is None or size < 0) else min(size, self.remaining)
+
+    def read(self, size=-1):
+        size = self.limit(size)
+        data = self.rfile.read(size) if size else b""
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        size = self.limit(size)
+        data = self.rfile.readline(size) if size else b""
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+    def drain(self, limit=None):
+        # skips the rest of the body, unless it's more than limit bytes;
+        # returns whether the end was reached
+        if limit is not None and self.remaining > limit:
+            return False
+        while self.remaining and self.read(65536):
+            pass
+        return not self.remaining
+
+class ChunkedBody(object):
+    # wsgi.input for a request body sent with chunked transfer coding: reads
+    # return the decoded content and stop at the last chunk, so the server
+    # can say that the input is terminated. Bad framing is the client's
+    # fault, so it's a 400.
+    def __init__(self, rfile):
+        self.rfile = rfile
+        self.chunk = 0
+        self.done = False
+
+    def next_chunk(self):
+        line = self.rfile.readline(1024)
+        try:
+            self.chunk = int(line.split(b";")[0].strip(), 16)
+        except ValueError:
+            raise exc.HTTPBadRequest(detail="Bad chunk size {0!r}".format(line))
+        if self.chunk == 0:
+            # skip the trailers
+            while self.rfile.readline(1024).strip():
+                pass
+            self.done = True
+
+    def read_chunk(self, size, read):
+        # reads at most size bytes (all for None or negative) of what's left
+        # of the current chunk, going to the next chunk when it's used up
+        if not self.chunk and not self.done:
+            self.next_chunk()
+        if self.done:
+            return b""
+        data = read(self.chunk if (size is None or size < 0) else min(size, self.chunk))
+        if not data:
+            raise exc.HTTPBadRequest(detail="Incomplete chunk")
+        self.chunk -= len(data)
+        if not self.chunk:
+            self.rfile.readline(1024)
+        return data
+
+    def read(self, size=-1):
+        parts = []
+        while size is None or size < 0 or size > 0:
+            data = self.read_chunk(size, self.rfile.read)
+            if not data:
+                break
+            parts.append(data)
+            if size is not None and size >= 0:
+                size -= len(data)
+        return b"".join(parts)
+
+    def readline(self, size=-1):
+        parts = []
+        while not (parts and parts[-1].endswith(b"\n")) and (size is None or size < 0 or size > 0):
+            data = self.read_chunk(size, self.rfile.readline)
+            if not data:
+                break
+            parts.append(data)
+            if size is not None and size >= 0:
+                size -= len(data)
+        return b"".join(parts)
+
+    def readlines(self, hint=-1):
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+    def drain(self, limit=None):
+        skipped = 0
+        try:
+            while not self.done and (limit is None or skipped <= limit):
+                skipped += len(self.read(65536))
+        except (IOError, exc.HTTPBadRequest):
+            return False
+        return self.done
+
+#
+# KeepAliveRequestHandler
+#
+
+class KeepAliveServerHandler(wsgiref.simple_server.ServerHandler):
+    http_version = "1.1"
+
+    def cleanup_headers(self):
+        wsgiref.simple_server.ServerHandler.cleanup_headers(self)
+        # without a length, the end of the response is the end of the connection
+        if "Content-Length" not in self.headers:
+            self.request_handler.close_connection = True
+        if self.request_handler.close_connection:
+            self.headers["Connection"] = "close"
+        elif self.request_handler.request_version == "HTTP/1.0":
+            self.headers["Connection"] = "keep-alive"
+
+class KeepAliveRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+    # serves requests on a connection until the client closes it, asks for
+    # it to be closed, or is idle for longer than timeout seconds; all that
+    # time it keeps the thread or process serving it busy
+    protocol_version = "HTTP/1.1"
+    timeout = 15
+    max_drain = 1024 * 1024
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.timeout:
+            self.close_connection = True
+            return
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.parse_request():
+            return
+
+        try:
+            length = int(self.headers.get("content-length") or 0)
+        except ValueError:
+            self.send_error(400)
+            return
+        environ = self.get_environ()
+        coding = self.headers.get("transfer-encoding", "").lower()
+        if coding == "chunked":
+            body = ChunkedBody(self.rfile)
+            environ["wsgi.input_terminated"] = True
+        else:
+            # other codings aren't delimited for us, so their end can't be found
+            if coding:
+                self.close_connection = True
+            body = RequestBody(self.rfile, length)
+        handler = KeepAliveServerHandler(
+            body, self.wfile, self.get_stderr(), environ,
+            multithread=bool(self.server.threads),
+            multiprocess=self.server.multiprocess
+        )
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        # a big body the app didn't want isn't worth reading just to keep
+        # the connection
+        if not body.drain(self.max_drain):
+            self.close_connection = True
+
+#
+# WSGIServer
+#
+
+class WSGIServer(wsgiref.simple_server.WSGIServer):
+    # With threads, connections are handled by a pool of that many worker
+    # threads, which start() starts in the process that does the serving;
+    # otherwise by the thread that calls handle_request().
+    timeout = 0.5
+
+    def __init__(self, address, handler, threads=0, multiprocess=False, bind_and_activate=True):
+        wsgiref.simple_server.WSGIServer.__init__(self, address, handler, bind_and_activate)
+        self.threads = threads
+        self.multiprocess = multiprocess
+        self.requests = None
+        self.workers = []
+        self.wakeup = None
+
+    def adopt(self, fd):
+        # take over a listening socket inherited from a server being reloaded
+        self.socket.close()
+        self.socket = socket.fromfd(fd, self.address_family, socket.SOCK_STREAM)
+        os.close(fd)
+        self.server_address = self.socket.getsockname()
+        self.server_name = socket.getfqdn(self.server_address[0])
+        self.server_port = self.server_address[1]
+        self.setup_environ()
+
+    def start(self):
+        if self.threads:
+            self.requests = queue.Queue(self.threads)
+            self.workers = [ threading.Thread(target=self.work) for _ in range(self.threads) ]
+            for worker in self.workers:
+                worker.daemon = True
+                worker.start()
+
+    def stop(self):
+        # let the workers finish the connections they have
+        for _ in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def process_request(self, request, client_address):
+        if not self.workers:
+            return wsgiref.simple_server.WSGIServer.process_request(self, request, client_address)
+        self.requests.put((request, client_address))
+
+    def work(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def wake_on_signals(self):
+        # have signals end wait() at once, instead of it waiting on after the
+        # signal handler asked the server to stop; only from the main thread
+        r, w = os.pipe()
+        for fd in (r, w):
+            if hasattr(os, "set_blocking"):
+                os.set_blocking(fd, False)
+            else:
+                import fcntl
+                fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        signal.set_wakeup_fd(w)
+        self.wakeup = r
+
+    def wait(self):
+        # waits at most timeout seconds for a connection, without relying on
+        # the socket's own timeout, which is 0 for a non-blocking socket
+        fds = [self] if self.wakeup is None else [self, self.wakeup]
+        try:
+            ready, _, _ = select.select(fds, [], [], self.timeout)
+        except (OSError, select.error) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            ready = []
+        if self.wakeup in ready:
+            try:
+                os.read(self.wakeup, 64)
+            except OSError:
+                pass
+        return self in ready
+
+    def serve(self, state):
+        # serve until a signal handler sets state["stop"]
+        self.start()
+        try:
+            while not state["stop"]:
+                if self.wait():
+                    self._handle_request_noblock()
+        finally:
+            self.stop()
+
+#
+# make_server
+#
+
+def make_server(ip, port, app, threads=0, processes=0, keep_alive=False, timeout=15, listen_fd=None):
+    if keep_alive:
+        handler = type("KeepAliveRequestHandler", (KeepAliveRequestHandler,), { "timeout": timeout })
+    else:
+        handler = wsgiref.simple_server.WSGIRequestHandler
+    server = WSGIServer((ip, port), handler, threads=threads, multiprocess=bool(processes),
+                        bind_and_activate=listen_fd is None)
+    if listen_fd is not None:
+        server.adopt(listen_fd)
+    server.set_app(app)
+    return server
+
+#
+# run_server
+#
+
+def _handle_signals(state, reload=True):
+    def stop(signum, frame):
+        state["stop"] = "reload" if (reload and signum == getattr(signal, "SIGHUP", None)) else "exit"
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, stop if reload else signal.SIG_IGN)
+
+def _reload(server):
+    # run the same command again in this process, handing it the listening
+    # socket, so that no connections are refused while the code is reloaded
+    fd = server.socket.fileno()
+    if hasattr(os, "set_inheritable"):
+        os.set_inheritable(fd, True)
+    os.environ[LISTEN_FD] = str(fd)
+    argv = getattr(sys, "orig_argv", [sys.executable] + sys.argv)
+    os.execv(sys.executable, [sys.executable] + argv[1:])
+
+def _fork_worker(server):
+    pid = os.fork()
+    if pid:
+        return pid
+    state = { "stop": None }
+    _handle_signals(state, reload=False)
+    server.wake_on_signals()
+    try:
+        server.serve(state)
+    except Exception:
+        traceback.print_exc()
+        os._exit(1)
+    os._exit(0)
+
+def _prefork(server, processes, state):
+    # all workers wait for the same socket; the ones that lose the race for
+    # a connection mustn't block in accept(), or they'd miss being stopped
+    server.socket.setblocking(False)
+    workers = set(_fork_worker(server) for _ in range(processes))
+    while not state["stop"]:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except OSError:
+            pid = 0
+        if pid in workers:
+            # replace a worker that died
+            workers.discard(pid)
+            workers.add(_fork_worker(server))
+        elif not pid:
+            time.sleep(0.2)
+    for pid in workers:
+        os.kill(pid, signal.SIGTERM)
+    if state["stop"] != "reload":
+        # workers left over from before a reload are reaped here too
+        while True:
+            try:
+                os.waitpid(-1, 0)
+            except OSError:
+                break
+
+def run_server(app, ip='', port=8000, threads=0, processes=0, keep_alive=False, timeout=15):
+    # With threads, requests are handled by a pool of that many threads; with
+    # processes, by that many forked processes sharing the listening socket.
+    # With keep_alive, a connection holds on to its thread or process until
+    # it's been idle for timeout seconds, so as many idle clients as there
+    # are workers block everyone else; that's why it's off by default.
+    # SIGHUP reloads the server without closing the socket, and SIGTERM or
+    # SIGINT stop it once current requests are done.
+    listen_fd = os.environ.pop(LISTEN_FD, None)
+    server = make_server(ip, port, fix_wsgiref(app), threads, processes, keep_alive, timeout,
+                         listen_fd=int(listen_fd) if listen_fd else None)
+    print('Serving on {0}:{1}'.format(ip, server.server_port))
+    sys.stdout.flush()
+
+    state = { "stop": None }
+    _handle_signals(state)
+    if processes:
+        _prefork(server, processes, state)
+    else:
+        server.wake_on_signals()
+        server.serve(state)
+
+    if state["stop"] == "reload":
+        _reload(server)
+    server.server_close()
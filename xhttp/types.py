@@ -5,6 +5,8 @@ import sys
 from . import exc
 from . import utils
 from . import conditional
+from . import negotiation
+from .cache import LockedLRUCache
 
 if sys.version_info[0] == 2:
     from urllib import unquote
@@ -32,9 +34,10 @@ class Resource(object):
 
     def HEAD(self, req, *a, **k):
         if hasattr(self, "GET"):
-            res = self.GET(req, *a, **k)
-            res.pop("x-content", None)
-            return res
+            def strip_content(res):
+                res.pop("x-content", None)
+                return res
+            return utils.then(lambda: self.GET(req, *a, **k), strip_content)
         else:
             raise exc.HTTPMethodNotAllowed(self.allowed, detail="GET")
 
@@ -55,34 +58,154 @@ class Resource(object):
 # class Router
 #
 
+def _literal_prefix(pattern):
+    # the literal text every match of pattern has to start with, or "" when
+    # that can't be told safely (alternation, flags that change matching)
+    if not isinstance(pattern.pattern, str) or (pattern.flags & ~re.UNICODE) or "|" in pattern.pattern:
+        return ""
+    source = pattern.pattern[1:] if pattern.pattern.startswith("^") else pattern.pattern
+    prefix = []
+    i = 0
+    while i < len(source):
+        c = source[i]
+        if c in "?*{":
+            prefix = prefix[:-1]
+            break
+        elif c == "+":
+            break
+        elif c == "\\" and i + 1 < len(source) and not source[i+1].isalnum():
+            prefix.append(source[i+1])
+            i += 2
+        elif c in ".^$[]()\\|}":
+            break
+        else:
+            prefix.append(c)
+            i += 1
+    return "".join(prefix)
+
+def _combinable(pattern):
+    # patterns with named groups, backreferences or global flags change
+    # meaning when embedded in a bigger regex
+    return (isinstance(pattern.pattern, str)
+            and not pattern.groupindex
+            and not (pattern.flags & ~re.UNICODE)
+            and not re.search(r"\\[0-9]|\(\?P=|\(\?\(", pattern.pattern))
+
 class Router(object):
     def __init__(self, *dispatch, **kwargs):
-        self.dispatch = [ (re.compile(pattern), handler) 
+        self.dispatch = [ (re.compile(pattern), handler)
                           for (pattern, handler) in dispatch ]
         self.prefix = kwargs.get('prefix', '/')
         self.prefix_re = re.compile('^' + self.prefix + '/*')
+        self.cache = kwargs.get('cache', None)
+        if isinstance(self.cache, int):
+            self.cache = LockedLRUCache(self.cache)
+        self.compile()
 
-    def find(self, path):
-        for (pattern, handler) in self.dispatch:
-            match = pattern.match(path)
+    def compile(self):
+        # A trie of the literal prefixes of all patterns. Every node at which
+        # a prefix ends holds the routes that can still match a path that
+        # reaches it, in dispatch order, with consecutive combinable patterns
+        # joined into one alternation regex. Since alternation tries branches
+        # left to right, the first route to match still wins.
+        self.trie = ({}, None)
+        ends = {}
+        for (index, (pattern, _)) in enumerate(self.dispatch):
+            node = self.trie
+            for c in _literal_prefix(pattern):
+                node = node[0].setdefault(c, ({}, None))
+            ends.setdefault(id(node), []).append(index)
+
+        def visit(node, inherited):
+            routes = sorted(inherited + ends.get(id(node), []))
+            children = { c: visit(child, routes) for (c, child) in node[0].items() }
+            segments = self.compile_segments(routes) if (id(node) in ends or node is self.trie) else None
+            return (children, segments)
+
+        self.trie = visit(self.trie, [])
+
+    def compile_segments(self, routes):
+        runs = []
+        for index in routes:
+            combinable = _combinable(self.dispatch[index][0])
+            if combinable and runs and runs[-1][0]:
+                runs[-1][1].append(index)
+            else:
+                runs.append((combinable, [index]))
+
+        segments = []
+        for (combinable, run) in runs:
+            if len(run) == 1:
+                pattern, handler = self.dispatch[run[0]]
+                segments.append((pattern, { None: (handler, 0, pattern.groups) }))
+                continue
+            source = "|".join("(?P<r{0}>{1})".format(index, self.dispatch[index][0].pattern) for index in run)
+            regex = re.compile(source)
+            table = { "r{0}".format(index): (self.dispatch[index][1],
+                                             regex.groupindex["r{0}".format(index)],
+                                             regex.groupindex["r{0}".format(index)] + self.dispatch[index][0].groups)
+                      for index in run }
+            segments.append((regex, table))
+        return segments
+
+    def candidates(self, path):
+        # segments for path and for path + "/", from a single walk of the trie
+        node = self.trie
+        segments = node[1]
+        for c in path:
+            node = node[0].get(c)
+            if node is None:
+                return (segments, segments)
+            if node[1] is not None:
+                segments = node[1]
+        node = node[0].get("/")
+        return (segments, node[1] if (node is not None and node[1] is not None) else segments)
+
+    def match(self, segments, path):
+        for (regex, table) in segments:
+            match = regex.match(path)
             if match:
-                return (handler, tuple(unquote(arg) for arg in match.groups()))
+                handler, start, stop = table[match.lastgroup if len(table) > 1 else None]
+                return (handler, tuple(unquote(arg) for arg in match.groups()[start:stop]))
         return (None, None)
 
+    def find(self, path):
+        return self.match(self.candidates(path)[0], path)
+
+    def resolve(self, path):
+        # returns (handler, args, slash) where slash tells whether the match
+        # was only found after appending a slash to path
+        segments, slash_segments = self.candidates(path)
+        handler, args = self.match(segments, path)
+        if handler:
+            return (handler, args, False)
+        if not path.endswith("/"):
+            handler, args = self.match(slash_segments, path + "/")
+            if handler:
+                return (handler, args, True)
+        return (None, None, False)
+
+    def route(self, path_info):
+        path = self.prefix_re.sub('/', path_info)
+        return (path,) + self.resolve(path)
+
     def __call__(self, request, *a, **k):
-        path = self.prefix_re.sub('/', request["x-path-info"])
-        handler, args = self.find(path)
+        if self.cache is None:
+            path, handler, args, slash = self.route(request["x-path-info"])
+        else:
+            # keyed on the router too, so nested routers can share one cache
+            key = (self, request["x-path-info"])
+            result = self.cache.get(key)
+            if result is None:
+                result = self.route(request["x-path-info"])
+                self.cache.put(key, result)
+            path, handler, args, slash = result
         if handler:
+            if slash and request["x-request-method"] in ["GET", "HEAD"]:
+                location = path + "/"
+                location += ("?" + request["x-query-string"]) if request["x-query-string"] else ""
+                raise exc.HTTPSeeOther(location)
             return handler(request, *(a + args))
-        elif not path.endswith("/"):
-            handler, args = self.find(path + "/")
-            if handler:
-                if request["x-request-method"] in ["GET", "HEAD"]:
-                    location = path + "/"
-                    location += ("?" + request["x-query-string"]) if request["x-query-string"] else ""
-                    raise exc.HTTPSeeOther(location)
-                else:
-                    return handler(request, *(a + args))
         raise exc.HTTPNotFound(detail=request["x-request-uri"])
 
 #
@@ -90,12 +213,27 @@ class Router(object):
 #
 
 class FileServer(Resource):
-    def __init__(self, path, content_type, last_modified=True, etag=False):
+    # With precompressed=True, sibling .br and .gz files that are at least as
+    # new as the file are served to clients accepting that encoding. With
+    # compress=True, other compressible files are gzipped in memory, once per
+    # file version, in a cache bounded to 32 MB unless another one is given.
+    # Files over COMPRESS_MAX_SIZE bytes, or too big for the cache, are sent
+    # as they are rather than compressed on every request.
+    ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+    COMPRESS_MAX_SIZE = 8 * 1024 * 1024
+
+    def __init__(self, path, content_type, last_modified=True, etag=False,
+                 precompressed=False, compress=False, cache=None):
         self.path = path
         self.content_type = content_type
         self.last_modified = last_modified
         self.etag = etag
-  
+        self.precompressed = precompressed
+        self.compress = compress
+        if compress and cache is None:
+            cache = LockedLRUCache(max_bytes=32 * 1024 * 1024)
+        self.cache = cache
+
     @conditional.if_modified_since
     @conditional.if_none_match
     @conditional.ranged
@@ -103,7 +241,52 @@ class FileServer(Resource):
         fullname = os.path.join(self.path, filename)
         if not os.path.abspath(fullname).startswith(os.path.abspath(self.path) + os.sep):
             raise exc.HTTPForbidden()
-        return utils.serve_file(fullname, self.content_type, self.last_modified, self.etag)
+        if not (self.precompressed or self.compress):
+            return utils.serve_file(fullname, self.content_type, self.last_modified, self.etag)
+        res = self.serve_encoded(req, fullname) if "accept-encoding" in req else None
+        res = res or utils.serve_file(fullname, self.content_type, self.last_modified, self.etag)
+        res["vary"] = "accept-encoding"
+        return res
+
+    def serve_encoded(self, req, fullname):
+        try:
+            stat = os.stat(fullname)
+        except (IOError, OSError):
+            return None
+
+        if self.precompressed:
+            available = {}
+            for (encoding, extension) in self.ENCODINGS:
+                try:
+                    if os.stat(fullname + extension).st_mtime >= stat.st_mtime:
+                        available[encoding] = extension
+                except (IOError, OSError):
+                    pass
+            encoding = negotiation.accept_encoding.choose(req["accept-encoding"], list(available)) if available else None
+            if encoding:
+                res = utils.serve_file(fullname + available[encoding], self.content_type, self.last_modified, self.etag)
+                res["content-encoding"] = encoding
+                return res
+
+        max_size = min(self.COMPRESS_MAX_SIZE, getattr(self.cache, "max_bytes", None) or self.COMPRESS_MAX_SIZE)
+        if (self.compress and stat.st_size <= max_size
+                and negotiation.accept_encoding.choose(req["accept-encoding"], ["gzip"])
+                and negotiation.accept_encoding.compressible(self.content_type, stat.st_size)):
+            res = utils.serve_file(fullname, self.content_type, self.last_modified, self.etag)
+            mtime_ns = getattr(stat, "st_mtime_ns", int(stat.st_mtime * 1000000000))
+            key = (os.path.abspath(fullname), stat.st_ino, stat.st_size, mtime_ns, "gzip")
+            content = self.cache.fetch(key, lambda: utils.gzip_encode(b"".join(res["x-content"])), sizeof=len)[0]
+            res.update({
+                "x-content": content,
+                "content-length": len(content),
+                "content-encoding": "gzip"
+            })
+            if "etag" in res:
+                etag = res["etag"]
+                res["etag"] = (etag[:-1] + '-gzip"') if etag.endswith('"') else (etag + "-gzip")
+            return res
+
+        return None
 
 #
 # Redirector
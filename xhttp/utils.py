@@ -2,7 +2,11 @@ import gzip
 import hashlib
 import os
 import sys
+import zlib
 
+from stat import S_ISREG
+
+from .cache import LockedLRUCache
 from .headers import DateHeader
 from . import exc
 
@@ -17,11 +21,27 @@ if sys.version_info[0] == 2:
 elif sys.version_info[0] == 3:
     import io
 
+if sys.version_info[0] == 2:
+    bytes, str = str, unicode # pragma: no flakes
+
 __all__ = [
     'decorator',
+    'then',
+    'LazyRequest',
+    'FileContent',
+    'content_length',
+    'read_range',
+    'RangeContent',
+    'MultipartRangeContent',
+    'file_etag',
     'serve_file',
+    'compress_iter',
     'gzip_encode',
-    'gzip_decode'
+    'gzip_encode_iter',
+    'gzip_decode',
+    'deflate_encode',
+    'deflate_encode_iter',
+    'deflate_decode'
 ]
 
 #
@@ -36,40 +56,328 @@ class decorator(object):
         if cls is None:
             return self
         new_func = self.func.__get__(obj, cls)
-        return self.__class__(new_func)
+        new_decorator = self.__class__(new_func)
+        # keep attributes set on the decorator, like those of @validators
+        for (name, value) in self.__dict__.items():
+            new_decorator.__dict__.setdefault(name, value)
+        return new_decorator
+
+#
+# then
+#
+
+def then(call, callback=None, errback=None):
+    # Runs call() and passes its result to callback, or an exception it raised
+    # to errback, returning what they return. If call() returns an awaitable
+    # (the handler is an async def), so does then(), which runs callback and
+    # errback once the awaitable is done. This way decorators can wrap both
+    # plain and async handlers.
+    try:
+        result = call()
+    except Exception as e:
+        if errback is None:
+            raise
+        return errback(e)
+    if hasattr(result, "__await__"):
+        from .asgi import then_async
+        return then_async(result, callback, errback)
+    return callback(result) if callback else result
+
+#
+# class LazyRequest
+#
+
+# Request keys are looked up in the environment (and parsed) on first access.
+# Anything that needs to see all keys materializes the rest, after which this
+# is just a plain dict.
+
+class LazyRequest(dict):
+    __slots__ = ['environment', 'getters', 'parsers']
+
+    def __init__(self, environment, getters, parsers):
+        super(LazyRequest, self).__init__()
+        self.environment = environment
+        self.getters = getters
+        self.parsers = parsers
+
+    def _lookup(self, key):
+        if key in self.getters:
+            value = self.getters[key](self.environment)
+        else:
+            name = "HTTP_" + key.upper().replace("-", "_")
+            if name not in self.environment:
+                raise KeyError(key)
+            value = self.environment[name]
+        if key in self.parsers:
+            value = self.parsers[key](value)
+        dict.__setitem__(self, key, value)
+        return value
+
+    def _materialize(self):
+        if self.environment is None:
+            return
+        names = set(self.getters)
+        names.update(name[5:].lower().replace("_", "-")
+                     for name in self.environment
+                     if name.startswith("HTTP_"))
+        for name in names:
+            if not dict.__contains__(self, name):
+                self._lookup(name)
+        self.environment = None
+
+    def __missing__(self, key):
+        if self.environment is None or not isinstance(key, (bytes, str)):
+            raise KeyError(key)
+        return self._lookup(key)
+
+    def __contains__(self, key):
+        if dict.__contains__(self, key):
+            return True
+        if self.environment is None or not isinstance(key, (bytes, str)):
+            return False
+        try:
+            self._lookup(key)
+            return True
+        except KeyError:
+            return False
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def _materializing(name):
+        method = getattr(dict, name)
+        def materializing(self, *a, **k):
+            self._materialize()
+            return method(self, *a, **k)
+        materializing.__name__ = name
+        return materializing
+
+    for _name in ["__iter__", "__len__", "__eq__", "__ne__", "__repr__", "__delitem__",
+                  "keys", "items", "values", "copy", "pop", "popitem", "clear"]:
+        locals()[_name] = _materializing(_name)
+    del _name, _materializing
+
+    __hash__ = None
+
+#
+# FileContent
+#
+
+CHUNK_SIZE = 65536
+
+class FileContent(object):
+    # x-content for a file on disk: it is read in chunks while iterating, so
+    # the file is never held in memory as a whole
+
+    def __init__(self, filename, size, chunk_size=CHUNK_SIZE):
+        self.filename = filename
+        self.size = size
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        with self.open() as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b""):
+                yield chunk
+
+    def open(self):
+        return open(self.filename, "rb")
+
+    def read_range(self, start, stop):
+        with self.open() as f:
+            f.seek(start)
+            return f.read(stop - start)
+
+#
+# content_length/read_range/RangeContent
+#
+
+def content_length(content):
+    # length of bytes, mmaps and objects with __len__, or of a seekable file;
+    # None for streams whose length isn't known without reading them
+    if hasattr(content, "__len__"):
+        return len(content)
+    if not (hasattr(content, "tell") and hasattr(content, "seek")):
+        return None
+    position = content.tell()
+    content.seek(0, os.SEEK_END)
+    length = content.tell()
+    content.seek(position)
+    return length
+
+def read_range(content, start, stop):
+    if hasattr(content, "read_range"):
+        return content.read_range(start, stop)
+    if hasattr(content, "seek") and not isinstance(content, (bytes, str)):
+        content.seek(start)
+        return content.read(stop - start)
+    return content[start:stop]
+
+class RangeContent(object):
+    # x-content for a byte window of a seekable source, read in chunks while
+    # iterating
+
+    def __init__(self, source, start, stop, chunk_size=CHUNK_SIZE):
+        self.source = source
+        self.start = start
+        self.stop = stop
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __iter__(self):
+        # a file is opened (or seeked) once for the window and read through
+        if isinstance(self.source, FileContent):
+            with self.source.open() as f:
+                for chunk in self.read_window(f):
+                    yield chunk
+        elif hasattr(self.source, "seek") and not isinstance(self.source, (bytes, str)):
+            for chunk in self.read_window(self.source):
+                yield chunk
+        else:
+            for offset in range(self.start, self.stop, self.chunk_size):
+                yield self.source[offset:min(offset + self.chunk_size, self.stop)]
+
+    def read_window(self, f):
+        f.seek(self.start)
+        remaining = self.stop - self.start
+        while remaining > 0:
+            chunk = f.read(min(self.chunk_size, remaining))
+            if not chunk:
+                return
+            remaining -= len(chunk)
+            yield chunk
+
+    def close(self):
+        if hasattr(self.source, "close"):
+            self.source.close()
+
+class MultipartRangeContent(object):
+    # x-content for a multipart/byteranges response, streaming each window
+    # from the source after its part header
+
+    def __init__(self, source, windows, length, content_type, boundary):
+        header = "\r\n--{0}\r\n".format(boundary)
+        if content_type:
+            header += "Content-Type: {0}\r\n".format(content_type)
+        header += "Content-Range: bytes {0}-{1}/{2}\r\n\r\n"
+        trailer = "\r\n--{0}--\r\n".format(boundary)
+        encode = (lambda s: s) if isinstance(source, str) else (lambda s: s.encode("us-ascii"))
+        self.source = source
+        self.parts = [ (encode(header.format(start, stop, length)), start, stop + 1) for (start, stop) in windows ]
+        self.trailer = encode(trailer)
+
+    def __len__(self):
+        return sum(len(header) + stop - start for (header, start, stop) in self.parts) + len(self.trailer)
+
+    def __iter__(self):
+        for (header, start, stop) in self.parts:
+            yield header
+            for chunk in RangeContent(self.source, start, stop):
+                yield chunk
+        yield self.trailer
+
+    def close(self):
+        if hasattr(self.source, "close"):
+            self.source.close()
 
 #
 # serve_file
 #
 
+# strong etags by file version, so each version of a file is hashed only once
+etag_cache = LockedLRUCache(4096)
+
+def file_etag(filename, stat, weak=False):
+    mtime_ns = getattr(stat, "st_mtime_ns", int(stat.st_mtime * 1000000000))
+    if weak:
+        return 'W/"{0:x}-{1:x}-{2:x}"'.format(stat.st_ino, stat.st_size, mtime_ns)
+    def compute():
+        digest = hashlib.sha256()
+        for chunk in FileContent(filename, stat.st_size):
+            digest.update(chunk)
+        return digest.hexdigest()
+    key = (os.path.abspath(filename), stat.st_ino, stat.st_size, mtime_ns)
+    return etag_cache.fetch(key, compute)[0]
+
 def serve_file(filename, content_type, last_modified=True, etag=False):
     try:
-        with open(filename, "rb") as f:
-            content = f.read()
-    except IOError as e:
+        stat = os.stat(filename)
+    except (IOError, OSError) as e:
         raise exc.HTTPNotFound(detail=e.strerror)
+    # the content is only read once the headers are sent, so anything that
+    # would keep it from being read has to be found out here
+    if not S_ISREG(stat.st_mode):
+        raise exc.HTTPNotFound(detail="Not a file")
+    if not os.access(filename, os.R_OK):
+        raise exc.HTTPForbidden(detail="Not readable")
     result = {
         "x-status": status.OK,
-        "x-content": content,
+        "x-content": FileContent(filename, stat.st_size),
         "content-type": content_type,
-        "content-length": len(content)
+        "content-length": stat.st_size
     }
     if last_modified:
-        result["last-modified"] = DateHeader(os.path.getmtime(filename))
+        result["last-modified"] = DateHeader(stat.st_mtime)
     if etag:
-        result["etag"] = hashlib.sha256(content).hexdigest()
+        result["etag"] = file_etag(filename, stat, weak=(etag == "weak"))
     return result
 
 #
-# gzip_encode/gzip_decode
+# compress_iter
+#
+
+def compress_iter(chunks, compress, finish):
+    # compress an iterable of bytes, yielding output as the compressor
+    # produces it
+    try:
+        for chunk in chunks:
+            data = compress(chunk)
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+#
+# gzip_encode/gzip_encode_iter/gzip_decode
 #
 
-def gzip_encode(s):
+def gzip_encode(s, level=9):
     z = io.BytesIO() 
-    with gzip.GzipFile(fileobj=z, mode="wb") as f:
+    with gzip.GzipFile(fileobj=z, mode="wb", compresslevel=level) as f:
         f.write(s)
     z.seek(0)
     return z.read()
 
+def gzip_encode_iter(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compress_iter(chunks, compressor.compress, compressor.flush)
+
 def gzip_decode(z):
     return gzip.GzipFile(fileobj=io.BytesIO(z), mode="rb").read()
+
+#
+# deflate_encode/deflate_encode_iter/deflate_decode
+#
+
+# HTTP's "deflate" is the zlib format (RFC 1950), not raw deflate
+
+def deflate_encode(s, level=6):
+    return zlib.compress(s, level)
+
+def deflate_encode_iter(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS)
+    return compress_iter(chunks, compressor.compress, compressor.flush)
+
+def deflate_decode(z):
+    return zlib.decompress(z)